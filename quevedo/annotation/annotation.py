@@ -3,8 +3,10 @@
 
 from enum import Flag
 import json
+import os
 from pathlib import Path
 from shutil import copyfile
+import threading
 
 Target = Flag('AnnotationTarget', 'LOGO GRAPH')
 
@@ -68,8 +70,14 @@ class Annotation:
         return {'meta': self.meta, 'fold': self.fold}
 
     def save(self):
-        '''Persist the information to the filesystem.'''
-        self.json_path.write_text(json.dumps(self.to_dict()))
+        '''Persist the information to the filesystem.
+
+        The file is replaced at once, so that other processes reading it never
+        find it half written.'''
+        tmp = self.json_path.with_name('.{}.{}-{}.tmp'.format(
+            self.json_path.name, os.getpid(), threading.get_ident()))
+        tmp.write_text(json.dumps(self.to_dict()))
+        os.replace(tmp, self.json_path)
 
     def create_from(self, *, image_path=None, binary_data=None,
                     pil_image=None, **kwds):
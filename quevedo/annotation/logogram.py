@@ -87,14 +87,25 @@ class BoundGrapheme(Grapheme):
         the parent logogram's image.'''
         if not hasattr(self, '_image_data'):
             img = self.logogram.image
-            width, height = img.size
-            w = float(self.box[2]) * width
-            h = float(self.box[3]) * height
-            l = float(self.box[0]) * width - (w / 2)
-            u = float(self.box[1]) * height - (h / 2)
-            self._image_data = img.crop((l, u, l + w, u + h))
+            self._image_data = img.crop(self.crop_box(img.size))
         return self._image_data
 
+    def crop_box(self, size):
+        '''Get the region of this grapheme in an image of the logogram.
+
+        Args:
+            size: (width, height) of the logogram image.
+
+        Returns:
+            the (left, upper, right, lower) pixel coordinates of the grapheme.
+        '''
+        width, height = size
+        w = float(self.box[2]) * width
+        h = float(self.box[3]) * height
+        l = float(self.box[0]) * width - (w / 2)
+        u = float(self.box[1]) * height - (h / 2)
+        return (l, u, l + w, u + h)
+
     @property
     def box(self):
         '''list[float]: Bounding box coordinates (x, y, w, h) of this grapheme
@@ -12,11 +12,12 @@ from quevedo.generate import generate
 from quevedo.run_script import run_script
 from quevedo.migrate import migrate
 from quevedo.split import split
+from quevedo.duplicates import duplicates
 
 
 @click.group(commands=[
     ds.config_edit, ds.info, ds.create, ds.add_images,
-    split, extract_graphemes, generate,
+    split, duplicates, extract_graphemes, generate,
     network.prepare, network.train,
     predict_image, test,
     web.launcher, run_script, migrate,
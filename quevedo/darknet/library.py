@@ -57,6 +57,18 @@ def c_array(ctype, values):
     return arr
 
 
+def image_plane(image):
+    """
+    Get the first channel of a PIL image as a float ("F" mode) image with values
+    in [0, 1], as darknet wants them. Crops of the result can be passed to
+    darknet directly, so it can be used to convert a logogram only once for all
+    of its graphemes.
+    """
+    if image.mode == 'F':
+        return image
+    return image.getchannel(0).convert('F').point(lambda v: v * (1 / 255))
+
+
 class BOX(Structure):
     _fields_ = [("x", c_float),
                 ("y", c_float),
@@ -264,11 +276,9 @@ class DarknetNetwork():
             # Since our images are b&w, we just get the r channel and repeat it
             # 3 times. FIXME: this is a hack and should be fixed and done properly
             w, h = image.size
-            img = lib.make_image(w, h, 3)
-            data = [c_float(pixel[0]/255.0) for pixel in image.getdata()]
-            data = data + data + data
-            img.data = c_array(c_float, data)
-            return img
+            plane = image_plane(image).tobytes()
+            data = (c_float * (w * h * 3)).from_buffer_copy(plane * 3)
+            return IMAGE(w, h, 3, data)
 
         def classify(net, meta, image):
             should_free = False
@@ -396,3 +406,25 @@ class DarknetNetwork():
         ret = self._classify(self.netMain, self.metaMain, image)
         if self.shutupDarknet: restore_stdio(suppressed)
         return ret
+
+    def detect_many(self, images, thresh= 0.25):
+        """
+        Same as detect, but for a list of images. Output redirection is only
+        done once, which saves time with many images.
+        """
+        if self.shutupDarknet: suppressed = supress_stdio()
+        ret = [self._detect(self.netMain, self.metaMain, image, thresh)
+               for image in images]
+        if self.shutupDarknet: restore_stdio(suppressed)
+        return ret
+
+    def classify_many(self, images):
+        """
+        Same as classify, but for a list of images. Output redirection is only
+        done once, which saves time with many images.
+        """
+        if self.shutupDarknet: suppressed = supress_stdio()
+        ret = [self._classify(self.netMain, self.metaMain, image)
+               for image in images]
+        if self.shutupDarknet: restore_stdio(suppressed)
+        return ret
@@ -6,10 +6,11 @@ from itertools import chain
 from os import listdir
 from pathlib import Path
 from string import Template
-from subprocess import run
+from subprocess import run, Popen, PIPE, STDOUT
 import toml
 
 from quevedo.annotation import Target, Logogram, Grapheme
+from quevedo.duplicates import ImageIndex
 from quevedo.network import create_network
 from quevedo.pipeline import create_pipeline
 
@@ -37,6 +38,7 @@ class Dataset:
         self.config_path = self._path / 'config.toml'
         self.local_config_path = self._path / 'config.local.toml'
         self.script_path = self._path / 'scripts'
+        self.cache_path = self._path / 'cache'
         self._networks = {}
         self._pipelines = {}
 
@@ -97,11 +99,26 @@ class Dataset:
         (self.grapheme_path).mkdir()
         (self.path / 'networks').mkdir()
 
-    def run_darknet(self, *args):
+    def run_darknet(self, *args, output=None):
+        '''Run the darknet binary with the given arguments (and the options in
+        the configuration).
+
+        Args:
+            output: if given, a function that will be called with each line
+                that darknet prints (both stdout and stderr), instead of letting
+                darknet print to the terminal.
+        '''
         darknet = self.config.get('darknet')
         if darknet is None:
             raise SystemExit("Darknet not configured for this dataset, configure it first")
-        run([darknet['path'], *args, *darknet['options']])
+        command = [darknet['path'], *args, *darknet['options']]
+        if output is None:
+            run(command)
+            return
+        with Popen(command, stdout=PIPE, stderr=STDOUT, text=True,
+                   errors='replace', bufsize=1) as proc:
+            for line in proc.stdout:
+                output(line)
 
     def list_networks(self):
         '''Get a list of all neural networks for this dataset.
@@ -136,7 +153,7 @@ class Dataset:
             list of [Pipelines](#pipeline)'''
         if 'pipeline' not in self.config:
             return []
-        return [create_pipeline(self, p) for p in self.config['pipeline'].keys()]
+        return [self.get_pipeline(p) for p in self.config['pipeline'].keys()]
 
     def get_pipeline(self, name):
         '''Get a pipeline by name.
@@ -265,7 +282,8 @@ class Dataset:
                        for d in path.glob('*') if d.is_dir()),
                       key=lambda s: s['name'])
 
-    def create_subset(self, target: Target, name, existing='a'):
+    def create_subset(self, target: Target, name, existing='a',
+                      return_mode=False):
         '''Creates the directory for a new subset.
 
         Args:
@@ -273,10 +291,14 @@ class Dataset:
             name: name for the new subset.
             existing: controls behaviour when the directory already exists.  It
                 can be 'a' to abort (the default), 'r' to remove existing
-                annotations, or 'm' (merge) to do nothing.
+                annotations, or 'm' (merge) to do nothing. If None, the user
+                is asked.
+            return_mode: return also the mode used for the existing directory.
 
         Returns:
-            the path of the created directory.
+            the path of the created directory. If `return_mode` is true, a tuple
+            of the path and the mode used ('r' or 'm'), or None if the directory
+            didn't exist.
         '''
         if target == Target.LOGO:
             path = self.logogram_path / name
@@ -284,20 +306,22 @@ class Dataset:
             path = self.grapheme_path / name
         else:
             raise ValueError('A single target is needed')
+        mode = None
         try:
             path.mkdir(parents=True)
         except FileExistsError:
-            if existing is None:
-                existing = click.prompt("Target directory already exists.\n"
+            mode = existing
+            if mode is None:
+                mode = click.prompt("Target directory already exists.\n"
                     "What to do? (m)erge/(r)eplace/(a)bort", default='a')[0]
-            if existing == 'r':
+            if mode == 'r':
                 for f in path.glob('*'):
                     f.unlink()
-            elif existing == 'm':
+            elif mode == 'm':
                 pass
             else:
                 raise click.Abort()
-        return path
+        return (path, mode) if return_mode else path
 
     def is_train(self, annotation):
         '''Checks if an annotation belongs to the training split.'''
@@ -387,6 +411,7 @@ def add_images(obj, image_dir, grapheme_set, logogram_set, existing, sort):
 
     dest_dir = dataset.create_subset(target, dest, existing)
 
+    added = []
     for d in image_dir:
         click.echo("Importing images from '{}' to '{}'...".format(
             d, dest_dir), nl=False)
@@ -397,11 +422,17 @@ def add_images(obj, image_dir, grapheme_set, logogram_set, existing, sort):
         elif sort == '1':
             sources = sorted(sources, key=lambda fn: int(fn.stem))
         for img in sources:
-            dataset.new_single(target, dest, image_path=img)
+            added.append(dataset.new_single(target, dest, image_path=img))
             num = num + 1
         click.echo("imported {}".format(style(num > 0, num)))
     click.echo("\n")
 
+    # Keep the duplicates index up to date if it is being used
+    index = ImageIndex(dataset)
+    if index.exists():
+        index.update(added)
+        index.save()
+
 
 def count(l):
     return sum(1 for _ in l)
@@ -0,0 +1,248 @@
+# 2026-10-19 Antonio F. G. Sevilla <afgs@ucm.es>
+# Licensed under the Open Software License version 3.0
+
+import click
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+import json
+from PIL import Image
+
+from quevedo.annotation import Target
+
+# Size of the side of the hash "image", so hashes have HASH_SIZE^2 bits
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+# Below this number of images, hashing in other processes is not worth it
+MIN_PARALLEL = 64
+
+
+def image_hash(path):
+    '''Compute the difference hash (dHash) of an image.
+
+    The image is reduced to a tiny grayscale thumbnail, and each bit of the hash
+    tells whether a pixel is brighter than its right neighbour. Similar images
+    have hashes which differ in few bits, which makes the hash robust to
+    rescaling, compression and small changes in exposure.
+
+    Returns:
+        the hash as an integer of `HASH_BITS` bits.
+    '''
+    img = Image.open(path).convert('L').resize((HASH_SIZE + 1, HASH_SIZE),
+                                               Image.BILINEAR)
+    px = list(img.getdata())
+    h = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            i = row * (HASH_SIZE + 1) + col
+            h = (h << 1) | (px[i] > px[i + 1])
+    return h
+
+
+def hamming(a, b):
+    '''Number of different bits between two hashes.'''
+    return bin(a ^ b).count('1')
+
+
+class ImageIndex:
+    '''Index of the perceptual hashes of the annotation images in a dataset,
+    used to find duplicated images.
+
+    The index is stored in the dataset cache directory, and updated
+    incrementally: only images which are new or have been modified since they
+    were last hashed are processed.
+
+    Args:
+        dataset: the [Dataset](#dataset) to index.
+    '''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        #: Path to the file where the index is stored.
+        self.path = dataset.cache_path / 'image_hashes.json'
+        try:
+            # key -> [image mtime, hash in hexadecimal]
+            self.entries = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            self.entries = {}
+
+    def exists(self):
+        '''Checks whether the index has been built and stored.'''
+        return self.path.exists()
+
+    def key(self, annotation):
+        '''Key for an annotation in the index (`<target>/<subset>/<id>`).'''
+        return annotation.image_path.relative_to(
+            self.dataset.path).with_suffix('').as_posix()
+
+    def update(self, annotations=None):
+        '''Hash the images which are new or changed.
+
+        Args:
+            annotations: annotations to index. By default, all annotations in
+                the dataset, in which case entries for images which no longer
+                exist are also removed.
+
+        Returns:
+            the number of images hashed.
+        '''
+        if annotations is None:
+            annotations = self.dataset.get_annotations()
+            self.entries = {k: e for k, e in self.entries.items()
+                            if (self.dataset.path / k).with_suffix('.png').exists()}
+
+        keys = []
+        paths = []
+        mtimes = []
+        for a in annotations:
+            key = self.key(a)
+            mtime = a.image_path.stat().st_mtime
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != mtime:
+                keys.append(key)
+                paths.append(a.image_path)
+                mtimes.append(mtime)
+
+        if len(paths) < MIN_PARALLEL:
+            hashes = map(image_hash, paths)
+        else:
+            with ProcessPoolExecutor() as pool:
+                hashes = list(pool.map(image_hash, paths, chunksize=32))
+
+        for key, mtime, h in zip(keys, mtimes, hashes):
+            self.entries[key] = [mtime, '{:016x}'.format(h)]
+        return len(keys)
+
+    def save(self):
+        '''Persist the index to the filesystem.'''
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(self.entries))
+
+    def clusters(self, keys=None, max_distance=0):
+        '''Find groups of duplicated images.
+
+        To avoid comparing every pair of images, hashes are split into
+        `max_distance + 1` bands. Two hashes with at most `max_distance`
+        different bits must share at least one band exactly, so only images
+        sharing some band are compared.
+
+        Args:
+            keys: keys of the images to consider, by default all in the index.
+            max_distance: maximum number of different bits between hashes for
+                images to be considered near-duplicates. With 0, only images
+                with identical hashes are grouped.
+
+        Returns:
+            a list of clusters, each a sorted list of keys, with more than one
+            image per cluster.
+        '''
+        if keys is None:
+            keys = list(self.entries.keys())
+        else:
+            keys = [k for k in keys if k in self.entries]
+        hashes = [int(self.entries[k][1], 16) for k in keys]
+
+        parent = list(range(len(keys)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        num_bands = max_distance + 1
+        width = HASH_BITS // num_bands
+        for b in range(num_bands):
+            shift = b * width
+            bits = width if b < num_bands - 1 else HASH_BITS - shift
+            mask = (1 << bits) - 1
+            buckets = {}
+            for i, h in enumerate(hashes):
+                buckets.setdefault((h >> shift) & mask, []).append(i)
+            for bucket in buckets.values():
+                if max_distance == 0:
+                    # The band is the whole hash, so all are identical
+                    for i in bucket[1:]:
+                        parent[find(i)] = find(bucket[0])
+                    continue
+                for n, i in enumerate(bucket):
+                    for j in bucket[:n]:
+                        if find(i) != find(j) and \
+                                hamming(hashes[i], hashes[j]) <= max_distance:
+                            parent[find(i)] = find(j)
+
+        groups = {}
+        for i, k in enumerate(keys):
+            groups.setdefault(find(i), []).append(k)
+        return sorted((sorted(g) for g in groups.values() if len(g) > 1),
+                      key=lambda g: g[0])
+
+
+@click.command('duplicates')
+@click.option('--grapheme-set', '-g', multiple=True, help="Grapheme set(s) to check.")
+@click.option('--logogram-set', '-l', multiple=True, help="Logogram set(s) to check.")
+@click.option('--distance', '-d', type=click.IntRange(0, HASH_BITS // 4), default=0,
+              help='Maximum number of different bits for images to be considered near-duplicates.')
+@click.pass_obj
+def duplicates(obj, grapheme_set, logogram_set, distance):
+    '''Find duplicated images in the dataset.
+
+    A perceptual hash of each image is computed and stored in the dataset
+    `cache` directory, so that later runs only need to process new or modified
+    images. Images with the same hash are reported as duplicates, and with the
+    `-d` option, also images whose hashes differ in a few bits (near-duplicates).
+
+    If neither `-g` nor `-l` are used, all annotations in the dataset are
+    checked, and if the special value "_ALL_" for either grapheme or logogram
+    sets is given, all sets for the chosen target are checked. Groups of
+    duplicates which have annotations both in train and test folds are marked,
+    since they leak information between the splits.'''
+
+    dataset = obj['dataset']
+
+    if len(grapheme_set) == 0 and len(logogram_set) == 0:
+        an = dataset.get_annotations()
+    else:
+        an = ()
+        if len(grapheme_set) > 0:
+            if grapheme_set[0] == '_ALL_':
+                grapheme_set = None
+            an = chain(an, dataset.get_annotations(Target.GRAPH, grapheme_set))
+        if len(logogram_set) > 0:
+            if logogram_set[0] == '_ALL_':
+                logogram_set = None
+            an = chain(an, dataset.get_annotations(Target.LOGO, logogram_set))
+
+    index = ImageIndex(dataset)
+    an = list(an)
+    num = index.update(an)
+    index.save()
+    click.echo("Hashed {} new or modified images".format(num))
+
+    clusters = index.clusters([index.key(a) for a in an], distance)
+    leaks = 0
+    for cluster in clusters:
+        splits = set()
+        lines = []
+        for key in cluster:
+            target, subset, id = key.split('/')
+            a = dataset.get_single(Target.LOGO if target == 'logograms'
+                                   else Target.GRAPH, subset, id)
+            if dataset.is_train(a):
+                splits.add('train')
+                split = ', train'
+            elif dataset.is_test(a):
+                splits.add('test')
+                split = ', test'
+            else:
+                split = ''
+            lines.append("  {} (fold {}{})".format(key, a.fold, split))
+        leak = len(splits) > 1
+        leaks += leak
+        click.secho("{} images{}".format(len(cluster),
+                    ' (in train and test folds)' if leak else ''),
+                    fg='red' if leak else None)
+        click.echo("\n".join(lines))
+
+    click.echo("Found {} groups of duplicates in {} images, {} across "
+               "train and test folds".format(len(clusters), len(an), leaks))
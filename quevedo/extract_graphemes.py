@@ -2,8 +2,52 @@
 # Licensed under the Open Software License version 3.0
 
 import click
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
 
-from quevedo.annotation import Target
+from quevedo.annotation import Target, Logogram, Grapheme
+
+
+def _extract_logogram(logo_path, graph_d, ids, source):
+    '''Crop all the graphemes of a logogram and store them with the given
+    ids. Run in worker processes.'''
+    logo = Logogram(logo_path)
+    # Decode the image only once, all crops are made from the loaded data
+    logo.image.load()
+    for g, id in zip(logo.graphemes, ids):
+        Grapheme(graph_d / str(id)).create_from(
+            pil_image=g.image, fold=logo.fold, tags=g.tags,
+            meta={'logogram': source})
+
+
+def _stamp(logo):
+    '''Modification times of a logogram's files, to detect changes.'''
+    return [logo.json_path.stat().st_mtime if logo.json_path.exists() else 0,
+            logo.image_path.stat().st_mtime]
+
+
+def _fill_holes(graph_d, holes, last, sources):
+    '''Move the last graphemes into the ids left free, so that numbering is
+    kept sequential. The records of the logograms the moved graphemes were
+    extracted from, in any of the `sources` (dictionaries of records), are
+    updated too. Returns the new last id.'''
+    owner = {id: r['ids'] for records in sources
+             for r in records.values() for id in r['ids']}
+    holes = sorted(holes)
+    hole_set = set(holes)
+    for h in holes:
+        while last in hole_set and last > h:
+            last -= 1
+        if last <= h:
+            break
+        for ext in ('.png', '.json'):
+            os.replace(graph_d / (str(last) + ext), graph_d / (str(h) + ext))
+        if last in owner:
+            ids = owner[last]
+            ids[ids.index(last)] = h
+        last -= 1
+    return last
 
 
 @click.command('extract')
@@ -15,6 +59,8 @@ from quevedo.annotation import Target
               help='''Merge new graphemes with existing ones, if any.''')
 @click.option('-r', '--replace', 'existing', flag_value='r',
               help='''Replace old graphemes with new ones, if any.''')
+@click.option('-u', '--update', 'existing', flag_value='u',
+              help='''Only extract again graphemes from logograms modified since the last extraction.''')
 @click.pass_obj
 def extract_graphemes(obj, dir_from, dir_to, existing):
     '''Extract graphemes from annotated logograms.
@@ -22,15 +68,82 @@ def extract_graphemes(obj, dir_from, dir_to, existing):
     This command takes all the logograms in the given subset, extracts the
     graphemes annotated in each of them, and stores them as independent
     annotations (carrying over the relevant information) in the chosen grapheme
-    subset.'''
+    subset. The logogram each grapheme comes from is recorded in the `logogram`
+    meta tag.
+
+    Logograms are processed in parallel. With `-u`, graphemes are only extracted
+    from logograms which are new or have changed since the last time they were
+    extracted to the same subset, replacing the ones extracted then.'''
 
     dataset = obj['dataset']
-    graph_d = dataset.create_subset(Target.GRAPH, dir_to, existing)
+    update = existing == 'u'
+    graph_d, mode = dataset.create_subset(Target.GRAPH, dir_to,
+                                          'm' if update else existing,
+                                          return_mode=True)
 
+    # Remember which graphemes were extracted from which logogram
+    state_path = dataset.cache_path / 'extract' / '{}.json'.format(dir_to)
+    state = {}
+    if mode == 'm' and state_path.exists():
+        state = json.loads(state_path.read_text())
+    previous = state.get(dir_from, {}) if update else {}
+
+    records = {}
+    jobs = []
+    free = []
     for logo in dataset.get_annotations(Target.LOGO, subset=dir_from):
-        for g in logo.graphemes:
-            dataset.new_single(Target.GRAPH, dir_to, pil_image=g.image,
-                               fold=logo.fold, tags=g.tags)
+        stamp = _stamp(logo)
+        old = previous.pop(logo.id, None)
+        if old is not None and old['stamp'] == stamp:
+            records[logo.id] = old
+            continue
+        old_ids = old['ids'] if old is not None else []
+        num = len(logo.graphemes)
+        free.extend(old_ids[num:])
+        records[logo.id] = {'stamp': stamp, 'ids': old_ids[:num]}
+        jobs.append((logo, num))
+    # Logograms no longer in the subset
+    for old in previous.values():
+        free.extend(old['ids'])
+
+    # Allocate ids beforehand, reusing those left free
+    next_id = sum(1 for _ in graph_d.glob('*.png')) + 1
+    free.sort(reverse=True)
+    for logo, num in jobs:
+        ids = records[logo.id]['ids']
+        while len(ids) < num:
+            if len(free) > 0:
+                ids.append(free.pop())
+            else:
+                ids.append(next_id)
+                next_id += 1
+
+    for id in free:
+        for ext in ('.png', '.json'):
+            try:
+                (graph_d / (str(id) + ext)).unlink()
+            except FileNotFoundError:
+                pass
+
+    with ProcessPoolExecutor() as pool:
+        list(pool.map(_extract_logogram,
+                      [logo.image_path for logo, _ in jobs],
+                      [graph_d] * len(jobs),
+                      [records[logo.id]['ids'] for logo, _ in jobs],
+                      ['{}/{}'.format(dir_from, logo.id) for logo, _ in jobs],
+                      chunksize=8))
+
+    if len(free) > 0:
+        # Graphemes extracted from other subsets may be moved too
+        others = [r for source, r in state.items() if source != dir_from]
+        _fill_holes(graph_d, free, next_id - 1, [records] + others)
+
+    state[dir_from] = records
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    state_path.write_text(json.dumps(state))
 
     (graph_d / 'README.md').write_text(
         'Graphemes extracted automatically from "{}" logograms'.format(dir_from))
+
+    click.echo("Extracted {} graphemes from {} logograms ({} unchanged)".format(
+        sum(num for _, num in jobs), len(jobs), len(records) - len(jobs)))
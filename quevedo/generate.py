@@ -2,12 +2,15 @@
 # Licensed under the Open Software License version 3.0
 
 import click
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import os
 from PIL import Image
 from PIL.ImageOps import invert
 import random
 import re
 
-from quevedo.annotation import Target
+from quevedo.annotation import Target, Logogram
 
 # Used only if force layout
 try:
@@ -23,38 +26,65 @@ except ImportError:
 config = {
     'count': 500,  # Number of files to generate
     'seed': None,  # Random seed for generation
-    'use_force': True,  # Use a force layout algorithm to distribute graphemes
+    # 'spread' (avoid overlaps), 'random' or 'force' (needs forcelayout). If not
+    # set, the force layout is used as in older versions (see 'use_force')
+    'layout': None,
     'width_range': [300, 500],  # A range of possible widths
     'height_range': [300, 500],  # A range of possible heights
 }
 
 
-def put_grapheme(canvas, x, y, file_info, name, rotate=False):
+# Number of random positions to try for each grapheme in the spread layout
+LAYOUT_TRIES = 30
+
+# Maximum number of grapheme images (counting each flipped or rotated variant)
+# to keep in memory, per process
+SPRITE_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=SPRITE_CACHE_SIZE)
+def _sprite(filename, flip=False, turns=0):
+    '''Image of a grapheme ready to be composited onto a logogram: flipped,
+    rotated and with white pixels converted to transparent. Cached, since the
+    same graphemes are placed again and again.'''
+    sim = Image.open(filename).convert("RGBA")
+    if flip:
+        sim = sim.transpose(Image.FLIP_LEFT_RIGHT)
+    if turns > 0:
+        sim = sim.rotate(turns * 90, resample=Image.BILINEAR, expand=True)
+    sim.putalpha(invert(sim.convert("L")))
+    return sim
+
+
+def pick_sprite(file_info, rotate=False, rng=random):
+    '''Get the image to place for a grapheme, randomly flipped and rotated if
+    `rotate` is true.'''
+    flip = False
+    turns = 0
+    if rotate:
+        flip = rng.random() > 0.5
+        turns = rng.randint(0, 4) % 4  # 4 turns are the same as none
+    return _sprite(file_info['filename'], flip, turns)
+
+
+def put_grapheme(canvas, x, y, file_info, name, rotate=False, rng=random,
+                 sprite=None):
     '''Put a grapheme into a logogram, and write the resulting darknet
-    bounding box annotation.'''
+    bounding box annotation. If the image to place (`sprite`) has not been
+    chosen with `pick_sprite`, it is done here.'''
 
     canvas_w = canvas.width
     canvas_h = canvas.height
 
-    sim = Image.open(file_info['filename']).convert("RGBA")
+    sim = sprite if sprite is not None else pick_sprite(file_info, rotate, rng)
     w = sim.width
     h = sim.height
-    if rotate:
-        if random.random() > 0.5:
-            sim = sim.transpose(Image.FLIP_LEFT_RIGHT)
-        turns = random.randint(0, 4)
-        sim = sim.rotate(turns * 90, resample=Image.BILINEAR, expand=True)
-        if turns % 2 > 0:
-            w, h = h, w
 
     if x + w > canvas_w:
         x -= x + w - canvas_w + 2
     if y + h > canvas_h:
         y -= y + h - canvas_h + 2
 
-    # Convert white pixels to transparent
-    sim.putalpha(invert(sim.convert("L")))
-
     canvas.alpha_composite(sim, (x, y))
     return {
         'tags': file_info['tags'],
@@ -63,33 +93,89 @@ def put_grapheme(canvas, x, y, file_info, name, rotate=False):
     }
 
 
-def create_logogram(graphemes):
-    '''Creates an image with randomly placed graphemes'''
-    canvas_w = random.randint(*config['width_range'])
-    canvas_h = random.randint(*config['height_range'])
+def spread_layout(sizes, width, height, rng=random, tries=LAYOUT_TRIES):
+    '''Place boxes in a canvas avoiding overlaps if possible.
+
+    Boxes are placed from biggest to smallest. Each one is put in the first of a
+    number of random positions (where it fits in the canvas) in which it doesn't
+    overlap the boxes already placed or, if there is none, in the position
+    where it overlaps the least.
+
+    Args:
+        sizes: list of (width, height) of the boxes.
+        width: width of the canvas.
+        height: height of the canvas.
+        rng: random number generator to use.
+        tries: maximum number of positions to try for each box.
+
+    Returns:
+        list of the [x, y] coordinates of the top left corner of each box.
+    '''
+    positions = [None] * len(sizes)
+    placed = []
+    for i in sorted(range(len(sizes)), reverse=True,
+                    key=lambda i: sizes[i][0] * sizes[i][1]):
+        w, h = sizes[i]
+        best = None
+        for _ in range(tries):
+            x = rng.randint(0, max(0, width - w))
+            y = rng.randint(0, max(0, height - h))
+            overlap = sum(max(0, min(x + w, px + pw) - max(x, px)) *
+                          max(0, min(y + h, py + ph) - max(y, py))
+                          for (px, py, pw, ph) in placed)
+            if best is None or overlap < best[0]:
+                best = (overlap, x, y)
+                if overlap == 0:
+                    break
+        _, x, y = best
+        placed.append((x, y, w, h))
+        positions[i] = [x, y]
+    return positions
+
+
+def create_logogram(graphemes, rng=random):
+    '''Creates an image with randomly placed graphemes, using the given random
+    number generator.'''
+    canvas_w = rng.randint(*config['width_range'])
+    canvas_h = rng.randint(*config['height_range'])
 
     class_names = []    # list of the names of the graphemes to place
     files = []          # list of the actual files
-    rotate = []         # list of whether to rotate each grapheme
-    positions = []      # list of the positions
+    sprites = []        # list of the images to place (maybe rotated)
 
     def add_grapheme(name, params):
         class_names.append(name)
-        files.append(random.choice(params['files']))
-        rotate.append(params['rotate'])
-        positions.append([random.randint(0, canvas_w), random.randint(0, canvas_h)])
+        file_info = rng.choice(params['files'])
+        files.append(file_info)
+        sprites.append(pick_sprite(file_info, params['rotate'], rng))
 
     # Iterate over the list of graphemes to find how many to place of each
     for name, params in graphemes.items():
-        if params['mode'] == 'one' and random.random() < params['freq']:
+        if params['mode'] == 'one' and rng.random() < params['freq']:
             add_grapheme(name, params)
         elif params['mode'] == 'many':
-            for _ in range(random.randint(0, params['max'])):
-                if random.random() < params['prob']:
+            for _ in range(rng.randint(0, params['max'])):
+                if rng.random() < params['prob']:
                     add_grapheme(name, params)
 
+    layout = config['layout']
+    if layout is None:
+        # Older configurations used the force layout by default, if available,
+        # and random positions otherwise
+        use_force = config.get('use_force', True) and can_use_force
+        layout = 'force' if use_force else 'random'
+    elif layout == 'force' and not can_use_force:
+        layout = 'spread'
+
+    if layout == 'spread':
+        positions = spread_layout([s.size for s in sprites],
+                                  canvas_w, canvas_h, rng)
+    else:
+        positions = [[rng.randint(0, canvas_w), rng.randint(0, canvas_h)]
+                     for _ in sprites]
+
     #  Use force layout to spread graphemes
-    if can_use_force and config['use_force'] and len(positions) > 1:
+    if layout == 'force' and len(positions) > 1:
         layout = fl.draw_spring_layout(dataset=np.array(positions), algorithm=fl.SpringForce)
         positions = layout.spring_layout()
 
@@ -105,38 +191,25 @@ def create_logogram(graphemes):
 
     # Create the actual logogram
     canvas = Image.new("RGBA", (canvas_w, canvas_h), "white")
-    graphemes = [put_grapheme(canvas, int(x), int(y), file_info, name, rotate)
-               for [x, y], name, file_info, rotate
-               in zip(positions, class_names, files, rotate)]
+    graphemes = [put_grapheme(canvas, int(x), int(y), file_info, name,
+                              rng=rng, sprite=sprite)
+               for [x, y], name, file_info, sprite
+               in zip(positions, class_names, files, sprites)]
     return canvas, graphemes
 
 
-@click.command()
-@click.option('-f', '--from', 'dir_from', default='default',
-              help='''Grapheme subset to use''')
-@click.option('-t', '--to', 'dir_to', default='default',
-              help='''Logogram subset where to place generated logograms.''')
-@click.option('-m', '--merge', 'existing', flag_value='m',
-              help='''Merge new logograms with existing ones, if any.''')
-@click.option('-r', '--replace', 'existing', flag_value='r',
-              help='''Replace old logograms with new ones, if any.''')
-@click.pass_obj
-def generate(obj, dir_from, dir_to, existing):
-    '''Generate artificial logograms from existing graphemes.
-
-    This command creates new logograms in the chosen subset by
-    randomly combining graphemes together. The generation process can be
-    somewhat controlled in the configuration file.
-
-    Since the goal of this process is to perform data augmentation for
-    training, only graphemes in "train" folds will be used. Generated logograms
-    will have the first fold use for training set as their fold.'''
-
-    dataset = obj['dataset']
-    dataset.create_subset(Target.LOGO, dir_to, existing)
+def load_job(dataset, dir_from):
+    '''Read the generation configuration of the dataset, and find the graphemes
+    in the given subset to use for generation.
 
+    Returns:
+        a dictionary describing the generation job, with the keys `graphemes`
+        (graphemes to use, grouped by the configured tag) and `seed`.
+    '''
     config.update(dataset.config.get('generate', {}))
-    random.seed(config['seed'])
+    seed = config['seed']
+    if seed is None:
+        seed = random.randrange(2**32)
     tag_name = config['tag']
 
     for param in config['params']:
@@ -168,9 +241,118 @@ def generate(obj, dir_from, dir_to, existing):
             }]
             graphemes[tag_value] = s
 
+    return {'graphemes': graphemes, 'seed': seed}
+
+
+# Information for the generation process, set in each worker process
+_job = {}
+
+
+def _init_job(job, job_config):
+    _job.update(job)
+    config.update(job_config)
+
+
+def _create_one(num):
+    '''Create the logogram number `num` of the job. Each logogram has its own
+    random generator, seeded from the job seed and its number, so results
+    don't depend on how work is distributed among processes.'''
+    rng = random.Random('{}:{}'.format(_job['seed'], num))
+    return create_logogram(_job['graphemes'], rng)
+
+
+def _generate_one(num):
+    '''Generate and store the logogram number `num` of the job.'''
+    img, gs = _create_one(num)
+    Logogram(_job['path'] / str(_job['first_id'] + num)).create_from(
+        pil_image=img, graphemes=gs, fold=_job['fold'])
+
+
+def stream_logograms(job, job_config, path, slots, labels, start=0, stop=None):
+    '''Write generated logograms into a ring of files for darknet training.
+
+    Instead of storing every generated logogram in the dataset, a fixed number
+    of `slots` is kept in `path`, each an image `<slot>.png` and its YOLO
+    label file `<slot>.txt`. Logograms are generated one after the other, each
+    replacing the oldest one, so that while darknet trains it keeps seeing new
+    data but disk use doesn't grow. Files are written to a temporary name and
+    then moved into place, so darknet never reads half-written files.
+
+    The image and its labels are replaced one after the other, and darknet
+    reads them separately too, so a slot being replaced while darknet loads it
+    can give it a label file that doesn't belong with the image. This can't
+    be avoided since darknet reads the list of files only once, but it is rare
+    and only affects single samples.
+
+    Args:
+        job: generation job as returned by `load_job`.
+        job_config: the generation configuration (`config` after `load_job`).
+        path: directory for the ring of files.
+        slots: number of logograms to keep.
+        labels: dictionary from grapheme tags (as a sorted tuple of items) to
+            the class index for darknet.
+        start: number of the first logogram to generate.
+        stop: a `multiprocessing.Event`. If given, generation goes on until it
+            is set. Otherwise, only one logogram per slot is generated.
+    '''
+    _init_job(job, job_config)
+    path.mkdir(parents=True, exist_ok=True)
+    num = start
+    while (num < start + slots) if stop is None else not stop.is_set():
+        img, gs = _create_one(num)
+        slot = path / str(num % slots + 1)
+        tmp = path / '_tmp'
+        tmp.with_suffix('.txt').write_text("".join(
+            "{} {} {} {} {}\n".format(labels[tuple(sorted(g['tags'].items()))],
+                                      *g['box']) for g in gs))
+        img.save(tmp.with_suffix('.png'), format='PNG')
+        os.replace(tmp.with_suffix('.txt'), slot.with_suffix('.txt'))
+        os.replace(tmp.with_suffix('.png'), slot.with_suffix('.png'))
+        num += 1
+
+
+@click.command()
+@click.option('-f', '--from', 'dir_from', default='default',
+              help='''Grapheme subset to use''')
+@click.option('-t', '--to', 'dir_to', default='default',
+              help='''Logogram subset where to place generated logograms.''')
+@click.option('-m', '--merge', 'existing', flag_value='m',
+              help='''Merge new logograms with existing ones, if any.''')
+@click.option('-r', '--replace', 'existing', flag_value='r',
+              help='''Replace old logograms with new ones, if any.''')
+@click.option('-j', '--jobs', type=click.IntRange(min=1),
+              help='''Number of processes to use (by default, one per CPU).''')
+@click.pass_obj
+def generate(obj, dir_from, dir_to, existing, jobs):
+    '''Generate artificial logograms from existing graphemes.
+
+    This command creates new logograms in the chosen subset by
+    randomly combining graphemes together. The generation process can be
+    somewhat controlled in the configuration file.
+
+    Since the goal of this process is to perform data augmentation for
+    training, only graphemes in "train" folds will be used. Generated logograms
+    will have the first fold use for training set as their fold.
+
+    Logograms are generated in parallel, but if a seed is set in the
+    configuration the results are the same regardless of the number of
+    processes used.'''
+
+    dataset = obj['dataset']
+    path = dataset.create_subset(Target.LOGO, dir_to, existing)
+
     # Generate as many logograms as requested
-    fold = dataset.config['train_folds'][0]
-    for _ in range(config['count']):
-        img, gs = create_logogram(graphemes)
-        dataset.new_single(Target.LOGO, dir_to, pil_image=img,
-            graphemes=gs, fold=fold)
+    job = load_job(dataset, dir_from)
+    job.update({
+        'path': path,
+        'first_id': sum(1 for _ in path.glob('*.png')) + 1,
+        'fold': dataset.config['train_folds'][0],
+    })
+    if jobs == 1:
+        _init_job(job, config)
+        for num in range(config['count']):
+            _generate_one(num)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_job,
+                                 initargs=(job, config)) as pool:
+            list(pool.map(_generate_one, range(config['count']), chunksize=16))
@@ -2,32 +2,61 @@
 # Licensed under the Open Software License version 3.0
 
 import click
+from contextlib import nullcontext
 import json
 
 from quevedo.annotation import Target, Grapheme, Logogram
 from quevedo.network.detect import match
+from quevedo.pipeline import PipelineMemo
+from quevedo.profiling import Profiler
+
+# Number of annotations that pipelines process together when testing
+TEST_BATCH = 64
 
 
 @click.command('predict')
-@click.option('--image', '-i', type=click.Path(exists=True),
-              required=True, help="Image to predict")
+@click.option('--image', '-i', type=click.Path(exists=True), multiple=True,
+              required=True, help="Image(s) to predict")
+@click.option('--save', is_flag=True, default=False,
+              help='Store pipeline predictions as annotation files next to the images')
+@click.option('--profile', is_flag=True, default=False,
+              help='Show the time spent in each step')
 @click.pass_obj
-def predict_image(obj, image):
-    '''Get predictions for an image using a trained neural network or
-    pipeline.'''
+def predict_image(obj, image, save, profile):
+    '''Get predictions for images using a trained neural network or
+    pipeline.
+
+    The `-i` option can be repeated to predict many images. Pipelines then read
+    the next images and write the results while running the networks. With
+    `--save`, pipeline results are also stored as annotation files with the
+    same name as each image, but `json` extension.
+
+    With `--profile`, the time spent by each network and pipeline step is
+    printed to the standard error.'''
 
     dataset = obj['dataset']
 
-    if 'pipeline' in obj:
-        pipeline = dataset.get_pipeline(obj['pipeline'])
-        r = pipeline.predict(image)
-        print(json.dumps(r.to_dict()))
-    else:
-        network = dataset.get_network(obj['network'])
-        if not network.is_trained():
-            raise SystemExit("Please train neural network '{}' first".format(
-                network.name))
-        print(network.predict(image))
+    profiler = Profiler()
+    with profiler if profile else nullcontext():
+        if 'pipeline' in obj:
+            pipeline = dataset.get_pipeline(obj['pipeline'])
+
+            def write(r):
+                if save:
+                    r.save()
+                print(json.dumps(r.to_dict()))
+
+            pipeline.predict_many(image, write)
+        else:
+            network = dataset.get_network(obj['network'])
+            if not network.is_trained():
+                raise SystemExit("Please train neural network '{}' first".format(
+                    network.name))
+            for r in network.predict_many(list(image)):
+                print(r)
+
+    if profile:
+        click.echo(profiler.format(), err=True)
 
 
 class Stats():
@@ -79,13 +108,23 @@ def safe_divide(a, b):
               help='Print all predictions into a `predictions.csv` file in the network directory')
 @click.option('--on-train', is_flag=True, default=False,
               help='Test the network on the train set instead of the test one')
-def test(obj, do_print, results_json, predictions_csv, on_train):
+@click.option('--memo/--no-memo', default=False,
+              help='Reuse results of pipeline network steps from previous runs')
+@click.option('--profile', is_flag=True, default=False,
+              help='Show the time spent in each step')
+def test(obj, do_print, results_json, predictions_csv, on_train, memo, profile):
     '''Compute evaluation metrics for a trained neural network or pipeline.
 
     By default annotations in test folds (see train/test split) are used.
     Accuracy is computed, and also separate accuracies for detection and
     classification. The full predictions can be printed into a csv for further
-    analysis with statistics software.'''
+    analysis with statistics software.
+
+    When testing pipelines, the `--memo` option stores the results of each
+    network step in the dataset `cache` directory, and reuses them in later
+    runs. Only steps whose network (configuration or weights) or input
+    annotation has changed are computed again. With `--profile`, the time
+    spent by each network and pipeline step is shown at the end.'''
 
     dataset = obj['dataset']
 
@@ -112,32 +151,45 @@ def test(obj, do_print, results_json, predictions_csv, on_train):
 
     if model.target == Target.GRAPH:
         stats = Stats(record, other_variables=('image', 'confidence'))
-        test_fn = test_grapheme
+        test_fn = test_graphemes
     else:
         stats = Stats(record, other_variables=('image', 'confidence', 'iou'))
-        test_fn = test_logogram
+        test_fn = test_logograms
 
     if do_print:
         print("Annotations tested: 0", end='\r')
     n = 0
 
-    if 'network' in obj:
-        for an in model.get_annotations(not on_train):
-            model.test(an, stats)
-            if do_print:
-                print("Annotations tested: {}".format(n), end='\r')
-                n += 1
-    elif 'pipeline' in obj:
-        try:
-            subsets = model.config.get('subsets')
-        except AttributeError:
-            subsets = None
-        for an in dataset.get_annotations(model.target, subsets):
-            if dataset.is_test(an):
-                test_fn(model, an, stats, join_tags)
+    profiler = Profiler()
+    with profiler if profile else nullcontext():
+        if 'network' in obj:
+            for an in model.get_annotations(not on_train):
+                model.test(an, stats)
                 if do_print:
                     print("Annotations tested: {}".format(n), end='\r')
                     n += 1
+        elif 'pipeline' in obj:
+            try:
+                subsets = model.config.get('subsets')
+            except AttributeError:
+                subsets = None
+            memo = PipelineMemo(dataset) if memo else None
+            # Annotations are run through the pipeline in batches
+            batch = []
+            for an in dataset.get_annotations(model.target, subsets):
+                if dataset.is_test(an):
+                    batch.append(an)
+                if len(batch) == TEST_BATCH:
+                    test_fn(model, batch, stats, join_tags, memo)
+                    n += len(batch)
+                    batch = []
+                    if do_print:
+                        print("Annotations tested: {}".format(n), end='\r')
+            if len(batch) > 0:
+                test_fn(model, batch, stats, join_tags, memo)
+                n += len(batch)
+            if memo is not None:
+                memo.save()
 
     if do_print:
         print("Annotations tested: {}".format(n))
@@ -150,6 +202,9 @@ def test(obj, do_print, results_json, predictions_csv, on_train):
     if do_print:
         click.echo(json.dumps(results, indent=4))
 
+    if profile:
+        click.echo(profiler.format())
+
     if results_json:
         path.mkdir(parents=True, exist_ok=True)
         file_path = path / f'{prefix}results.json'
@@ -160,23 +215,25 @@ def test(obj, do_print, results_json, predictions_csv, on_train):
         click.echo("Printed predictions to '{}'".format(record_path.resolve()))
 
 
-def test_grapheme(pipeline, an, stats, join_tags):
-    p = Grapheme(image=an.image)
-    pipeline.run(p)
-    truth = join_tags(an.tags)
-    pred = join_tags(p.tags)
-    stats.register(prediction=pred, truth=truth,
-            image=an.image_path.relative_to(pipeline.dataset.path),
-            confidence=p.meta.get('confidence', 0))
-
-
-def test_logogram(pipeline, an, stats, join_tags):
-    p = Logogram(image=an.image)
-    pipeline.run(p)
-    for x, y, iou in match(an.graphemes, p.graphemes):
-        truth = join_tags(x.tags) if x is not None else None
-        pred = join_tags(y.tags) if y is not None else None
-        confidence = y.meta['confidence'] if y is not None else 0
+def test_graphemes(pipeline, annotations, stats, join_tags, memo=None):
+    preds = [Grapheme(image=an.image) for an in annotations]
+    pipeline.run_many(preds, memo)
+    for an, p in zip(annotations, preds):
+        truth = join_tags(an.tags)
+        pred = join_tags(p.tags)
         stats.register(prediction=pred, truth=truth,
                 image=an.image_path.relative_to(pipeline.dataset.path),
-                confidence=confidence, iou=iou)
+                confidence=p.meta.get('confidence', 0))
+
+
+def test_logograms(pipeline, annotations, stats, join_tags, memo=None):
+    preds = [Logogram(image=an.image) for an in annotations]
+    pipeline.run_many(preds, memo)
+    for an, p in zip(annotations, preds):
+        for x, y, iou in match(an.graphemes, p.graphemes):
+            truth = join_tags(x.tags) if x is not None else None
+            pred = join_tags(y.tags) if y is not None else None
+            confidence = y.meta['confidence'] if y is not None else 0
+            stats.register(prediction=pred, truth=truth,
+                    image=an.image_path.relative_to(pipeline.dataset.path),
+                    confidence=confidence, iou=iou)
@@ -6,6 +6,8 @@ from string import Template
 
 from .network import Network
 from quevedo.annotation import Target, Grapheme
+from quevedo.annotation.logogram import BoundGrapheme
+from quevedo.profiling import profiled
 
 
 class ClassifyNet(Network):
@@ -38,7 +40,7 @@ class ClassifyNet(Network):
         if tag is not None:
             tag_set.add(tag)
 
-    def _prepare_annotation(self, annotation, num, tag_set):
+    def _prepare_annotation(self, annotation, num, tag_index):
         # For CNN, no need to write a label file, just put the label in the
         # filename
         tag = self.get_tag(annotation.tags)
@@ -65,12 +67,21 @@ class ClassifyNet(Network):
             num_classes=num_classes,
             num_connected=num_classes * 10)
 
-    def predict(self, image):
+    def _to_graphemes(self, classification):
         return [Grapheme(
             tags=self.prediction_to_tag(
                 self.tag_map[tag.decode('utf8')]),
             meta={'confidence': conf})
-                for (tag, conf) in self._darknet.classify(image)]
+                for (tag, conf) in classification]
+
+    @profiled
+    def predict(self, image):
+        return self._to_graphemes(self._darknet.classify(image))
+
+    @profiled
+    def predict_many(self, images):
+        return [self._to_graphemes(c)
+                for c in self._darknet.classify_many(images)]
 
     def test(self, annotation, stats):
         true_tag = self.get_tag(annotation.tags)
@@ -88,7 +99,36 @@ class ClassifyNet(Network):
             image=annotation.image_path.relative_to(self.dataset.path),
             confidence=confidence)
 
+    @profiled
     def auto_annotate(self, a):
         preds = self.predict(a.image)
         if len(preds) > 0:
             a.tags.update(preds[0].tags)
+
+    @profiled
+    def auto_annotate_many(self, annotations):
+        predictions = self.predict_many(grapheme_images(annotations))
+        for a, preds in zip(annotations, predictions):
+            if len(preds) > 0:
+                a.tags.update(preds[0].tags)
+
+
+def grapheme_images(annotations):
+    '''Get the images of graphemes, ready to be classified.
+
+    Logogram images are converted into darknet format only once, and then all
+    of their bound graphemes cropped from the result, instead of converting
+    each grapheme crop separately.'''
+    from quevedo.darknet.library import image_plane
+    planes = {}
+    images = []
+    for a in annotations:
+        if isinstance(a, BoundGrapheme):
+            key = id(a.logogram)
+            if key not in planes:
+                planes[key] = image_plane(a.logogram.image)
+            plane = planes[key]
+            images.append(plane.crop(a.crop_box(plane.size)))
+        else:
+            images.append(a.image)
+    return images
@@ -30,6 +30,8 @@ def train(obj, resume):
     The training configuration and files must have been created by running the
     command `prepare`.  The weights obtained after training are stored in the
     network directory: `/<dataset>/networks/<network_name>/darknet_final.weights`.
+    Loss, learning rate and speed for each iteration are recorded in
+    `train_metrics.csv` in the same directory.
     '''
 
     dataset = obj['dataset']
@@ -43,7 +45,16 @@ def train(obj, resume):
         initial = 'darknet_final.weights'
         click.echo("Resuming training")
 
-    weights = network.train(initial=initial)
+    def show_progress(m):
+        eta = ''
+        if m['hours_left'] is not None and m['hours_left'] >= 0:
+            eta = ', {:.2f} hours left'.format(m['hours_left'])
+        click.echo("Iteration {}: loss {:.4f} (avg {:.4f}), rate {:g}, "
+                   "{:.1f} img/s, {:.0f}s elapsed{}".format(
+                       m['iteration'], m['loss'], m['avg_loss'], m['rate'],
+                       m['images_per_second'], m['elapsed'], eta))
+
+    weights = network.train(initial=initial, progress=show_progress)
 
     if weights is None:
         click.echo("Training interrupted, no weights produced")
@@ -1,14 +1,19 @@
 # 2021-04-21 Antonio F. G. Sevilla <afgs@ucm.es>
 # Licensed under the Open Software License version 3.0
 
+from contextlib import contextmanager
 import json
+import multiprocessing
 from pathlib import Path
 from PIL import Image
+import signal
 from string import Template
 
 from .network import Network
 from quevedo.annotation import Target
 from quevedo.annotation.logogram import Logogram, BoundGrapheme
+from quevedo import generate
+from quevedo.profiling import profiled
 
 
 class DetectNet(Network):
@@ -31,15 +36,77 @@ class DetectNet(Network):
             raise KeyError("Error getting annotations for logogram {} ({})".format(
                 annotation.id, json.dumps(annotation.to_dict())))
 
-    def _prepare_annotation(self, annotation, num, tag_set):
+    def _prepare_annotation(self, annotation, num, tag_index):
+        return "{}.png".format(num)
+
+    def _write_train_files(self, annotation, link_name, tag_index):
+        super()._write_train_files(annotation, link_name, tag_index)
         # For YOLO, we write an adjacent txt file with the bounding boxes and
         # the class (its index)
-        link_name = "{}.png".format(num)
         (self.train_path / link_name).with_suffix(".txt").write_text(
             "".join("{} {} {} {} {}\n".format(
-                tag_set.index(self.get_tag(g.tags)),
+                tag_index[self.get_tag(g.tags)],
                 *g.box) for g in annotation.graphemes))
-        return link_name
+
+    # Streaming of generated training data
+
+    def _stream_job(self):
+        '''Generation job for the graphemes configured for streaming.'''
+        if not hasattr(self, '_stream'):
+            self._stream = generate.load_job(self.dataset, self.config['stream']['from'])
+        return self._stream
+
+    def _stream_labels(self, tag_index):
+        '''Map from grapheme tags to darknet classes for streamed logograms.
+        Graphemes whose class is not known to the network are not used.'''
+        job = self._stream_job()
+        labels = {}
+        for params in job['graphemes'].values():
+            params['files'] = [f for f in params['files']
+                               if self.get_tag(f['tags']) in tag_index]
+            for f in params['files']:
+                labels[tuple(sorted(f['tags'].items()))] = tag_index[self.get_tag(f['tags'])]
+        job['graphemes'] = {k: p for k, p in job['graphemes'].items()
+                            if len(p['files']) > 0}
+        return labels
+
+    def _extra_tags(self):
+        if 'stream' not in self.config:
+            return set()
+        return set(self.get_tag(f['tags'])
+                   for params in self._stream_job()['graphemes'].values()
+                   for f in params['files']) - {None}
+
+    def _prepare_extra(self, tag_index):
+        if 'stream' not in self.config:
+            return []
+        # Fill the ring once so darknet finds all files from the start
+        slots = self.config['stream'].get('slots', 1000)
+        generate.stream_logograms(self._stream_job(), generate.config,
+                                  self.train_path / 'stream', slots,
+                                  self._stream_labels(tag_index))
+        return ['stream/{}.png'.format(n + 1) for n in range(slots)]
+
+    @contextmanager
+    def _training_data(self):
+        if 'stream' not in self.config:
+            yield
+            return
+        tag_map = json.loads((self.path / 'tag_map.json').read_text())
+        tag_index = {tag: i for i, tag in enumerate(sorted(tag_map.keys()))}
+        labels = self._stream_labels(tag_index)
+        slots = self.config['stream'].get('slots', 1000)
+        stop = multiprocessing.Event()
+        streamer = multiprocessing.Process(target=_run_stream, daemon=True,
+            args=(self._stream_job(), generate.config,
+                  (self.path / 'train' / 'stream').resolve(), slots, labels,
+                  slots, stop))
+        streamer.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            streamer.join()
 
     def _get_net_config(self, num_classes):
         template = Template((Path(__file__).parent.parent /
@@ -62,10 +129,7 @@ class DetectNet(Network):
             num_steps_1=int(num_max_batches * 80 / 100),
             num_steps_2=int(num_max_batches * 90 / 100))
 
-    def predict(self, image):
-
-        if not isinstance(image, Image.Image):
-            image = Image.open(image)
+    def _to_logogram(self, image, detections):
 
         def clamp(val, minim, maxim):
             return min(maxim, max(minim, val))
@@ -83,9 +147,22 @@ class DetectNet(Network):
             meta={'confidence': c},
             tags=self.prediction_to_tag(self.tag_map[s]),
             box=make_bbox(width, height, *b))
-            for (s, c, b) in self._darknet.detect(image)]
+            for (s, c, b) in detections]
         return ret
 
+    @profiled
+    def predict(self, image):
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        return self._to_logogram(image, self._darknet.detect(image))
+
+    @profiled
+    def predict_many(self, images):
+        images = [i if isinstance(i, Image.Image) else Image.open(i)
+                  for i in images]
+        return [self._to_logogram(i, d) for i, d in
+                zip(images, self._darknet.detect_many(images))]
+
     def test(self, annotation, stats):
         prediction = self.predict(annotation.image_path)
         image = annotation.image_path.relative_to(self.dataset.path)
@@ -99,10 +176,24 @@ class DetectNet(Network):
             stats.register(prediction=pred, truth=truth,
                 image=image, confidence=confidence, iou=iou)
 
+    @profiled
     def auto_annotate(self, a):
         predicted = self.predict(a.image)
         a.update(graphemes=predicted.graphemes)
 
+    @profiled
+    def auto_annotate_many(self, annotations):
+        predictions = self.predict_many([a.image for a in annotations])
+        for a, predicted in zip(annotations, predictions):
+            a.update(graphemes=predicted.graphemes)
+
+
+def _run_stream(*args):
+    # Interrupting training (Ctrl-C) is handled by the parent process, which
+    # will then stop the streamer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    generate.stream_logograms(*args)
+
 
 # Utilities for YOLO
 
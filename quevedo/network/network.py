@@ -1,14 +1,60 @@
 # 2020-10-08 Antonio F. G. Sevilla <afgs@ucm.es>
 # Licensed under the Open Software License version 3.0
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import json
 import os
 from pathlib import Path
+from itertools import chain
+import re
 from shutil import rmtree
+from time import time
+
+from quevedo.profiling import profiled
 
 
 TAG_JOIN_CHAR = ''
 
+# Darknet prints a line like these after each training iteration (the first
+# is from detector training, the second from classifier training):
+#    100: 1.234, 1.456 avg loss, 0.001000 rate, 2.5 seconds, 6400 images, 1.2 hours left
+#   100, 0.512: 1.234, 1.456 avg, 0.001000 rate, 2.5 seconds, 6400 images, 1.2 hours left
+PROGRESS_RE = re.compile(r'^\s*(\d+)(?:,\s*[\d.]+)?:\s*(\S+),\s*(\S+) avg(?: loss)?,'
+                         r'\s*(\S+) rate,\s*(\S+) seconds,\s*(\d+) images'
+                         r'(?:,\s*(\S+) hours left)?')
+
+#: Columns of the training metrics file
+TRAIN_METRICS = ('iteration', 'loss', 'avg_loss', 'rate', 'images_per_second',
+                 'elapsed', 'hours_left')
+
+
+def parse_progress(line):
+    '''Parse a line of darknet training output.
+
+    Returns:
+        a dictionary with the values in `TRAIN_METRICS` except `elapsed`, or
+        None if the line is not an iteration report.'''
+    m = PROGRESS_RE.match(line)
+    if m is None:
+        return None
+    iteration, loss, avg_loss, rate, seconds, images, hours_left = m.groups()
+    try:
+        iteration = int(iteration)
+        seconds = float(seconds)
+        # Darknet reports the total number of images seen so far
+        batch = int(images) / iteration if iteration > 0 else 0
+        return {
+            'iteration': iteration,
+            'loss': float(loss),
+            'avg_loss': float(avg_loss),
+            'rate': float(rate),
+            'images_per_second': batch / seconds if seconds > 0 else 0,
+            'hours_left': float(hours_left) if hours_left is not None else None,
+        }
+    except ValueError:
+        return None
+
 
 class Network:
     ''' Class representing a neural net to train and predict logograms or
@@ -62,6 +108,11 @@ class Network:
         weights = self.path / 'darknet_final.weights'
         return weights.exists()
 
+    def load(self):
+        '''Load the trained weights, which is otherwise done when the network is
+        first used.'''
+        self._darknet
+
     def get_annotations(self, test=False):
         '''Get the annotations configured for use with this network.
 
@@ -86,11 +137,34 @@ class Network:
         collecting all tags prior to training).'''
         raise NotImplementedError
 
-    def _prepare_annotation(self, annotation, num, tag_set):
-        '''Prepare the files needed to train this annotation. Return the name
-        that the final file (link or copy) should have.'''
+    def _prepare_annotation(self, annotation, num, tag_index):
+        '''Return the name that the final file (link or copy) for this
+        annotation should have, or None to leave it out of training. Should
+        not touch the filesystem, files are written later by
+        `_write_train_files`.'''
         raise NotImplementedError
 
+    def _write_train_files(self, annotation, link_name, tag_index):
+        '''Write the files needed to train this annotation. May be called
+        concurrently for different annotations.'''
+        os.symlink(annotation.image_path.resolve(), self.train_path / link_name)
+
+    def _extra_tags(self):
+        '''Override to add tags used by training data which doesn't come from
+        the annotations.'''
+        return set()
+
+    def _prepare_extra(self, tag_index):
+        '''Override to create additional training files which don't come from
+        the annotations. Return the list of their names, relative to the train
+        directory.'''
+        return []
+
+    @contextmanager
+    def _training_data(self):
+        '''Override to do work in the background while darknet is training.'''
+        yield
+
     def _get_net_config(self, num_classes):
         '''Get the darknet architecture (.cfg file contents) for this net.'''
         raise NotImplementedError
@@ -115,6 +189,7 @@ class Network:
         all_tags = set()
         for t in annotations:
             self._update_tag_set(all_tags, t)
+        all_tags.update(self._extra_tags())
         all_tags = sorted(all_tags)
 
         # We build a map from our tags to arbitrary labels for darknet not to
@@ -130,18 +205,33 @@ class Network:
         names_file = self.path / 'obj.names'
         names_file.write_text("\n".join(self.tag_map.values()) + "\n")
 
+        # Index of each tag in the sorted list, which is the class number
+        # darknet expects in label files
+        tag_index = {tag: i for i, tag in enumerate(all_tags)}
+
         # Create links to the images in the train folder, with class in the name
         # in classification and an additional txt file with bounding boxes for
-        # detection
-        with open(self.path / 'train.txt', 'w') as train_file:
-            num = 1
-            for t in annotations:
-                link_name = self._prepare_annotation(t, num, all_tags)
-                if link_name is None:
-                    continue
-                num = num + 1
-                os.symlink(t.image_path.resolve(), self.train_path / link_name)
-                train_file.write("train/{}\n".format(link_name))
+        # detection. Names are assigned in order, but files are written in
+        # parallel since there can be many thousands of them.
+        to_write = []
+        num = 1
+        for t in annotations:
+            link_name = self._prepare_annotation(t, num, tag_index)
+            if link_name is None:
+                continue
+            num = num + 1
+            to_write.append((t, link_name))
+
+        with ThreadPoolExecutor() as pool:
+            # Consume the results so exceptions in workers are raised here
+            list(pool.map(lambda w: self._write_train_files(*w, tag_index),
+                          to_write))
+
+        extra = self._prepare_extra(tag_index)
+
+        (self.path / 'train.txt').write_text("".join(
+            "train/{}\n".format(link_name) for link_name in
+            chain((link_name for _, link_name in to_write), extra)))
 
         # Write meta-configuration information in the darknet data file
         (self.path / 'darknet.data').write_text(("classes = {}\n"
@@ -152,15 +242,26 @@ class Network:
         (self.path / 'darknet.cfg').write_text(
             self._get_net_config(num_classes))
 
-    def train(self, initial=None):
+    def train(self, initial=None, progress=None):
         '''Trains the neural network.
 
         When finished, removes partial weights and keeps only the last. Can be
         interrupted and optionally resumed later.
 
+        The loss, learning rate and throughput reported by darknet after each
+        iteration are stored in the file `train_metrics.csv` in the network
+        directory. When resuming, new values are appended to the file.
+
         Args:
             initial: path to the weights from which to resume training.
+            progress: function to call after each training iteration with a
+                dictionary of the metrics (see `TRAIN_METRICS`). Other output
+                from darknet is printed as is.
         '''
+        with self._training_data():
+            return self._train(initial, progress)
+
+    def _train(self, initial, progress):
         oldcwd = os.getcwd()
         os.chdir(self.path)
         final = None
@@ -173,13 +274,35 @@ class Network:
         if initial:
             args.append(initial)
 
+        metrics_path = Path('train_metrics.csv')
+        resuming = initial is not None and metrics_path.exists()
+        metrics_file = open(metrics_path, 'a' if resuming else 'w')
+        if not resuming:
+            print(*TRAIN_METRICS, sep=',', file=metrics_file, flush=True)
+        start = time()
+
+        def on_output(line):
+            metrics = parse_progress(line)
+            if metrics is None:
+                print(line, end='', flush=True)
+                return
+            metrics['elapsed'] = round(time() - start, 3)
+            # Missing values are left empty, so the file can be read as numbers
+            print(*('' if metrics[k] is None else metrics[k]
+                    for k in TRAIN_METRICS), sep=',',
+                  file=metrics_file, flush=True)
+            if progress is not None:
+                progress(metrics)
+
         try:
-            self.dataset.run_darknet(*args)
+            self.dataset.run_darknet(*args, output=on_output)
             final = 'darknet_final.weights'
         except KeyboardInterrupt:
             final = 'darknet_last.weights'
             if not (weight_d / final).exists():
                 final = None
+        finally:
+            metrics_file.close()
 
         if final is not None:
             os.replace(str(weight_d / final), 'darknet_final.weights')
@@ -238,6 +361,21 @@ class Network:
             '''
         raise NotImplementedError
 
+    @profiled
+    def predict_many(self, images):
+        '''Get predictions for a list of images.
+
+        Equivalent to calling `predict` for each image, but faster for many
+        images.
+
+        Args:
+            images: list of paths to images, or PIL images.
+
+        Returns:
+            a list with the results of `predict` for each image.
+        '''
+        return [self.predict(i) for i in images]
+
     def test(self, annotation, stats):
         '''Method to test the network on an annotation.
 
@@ -260,3 +398,10 @@ class Network:
                 this network's predictions.
         '''
         raise NotImplementedError
+
+    @profiled
+    def auto_annotate_many(self, annotations):
+        '''Automatically annotate a list of annotations, like `auto_annotate`
+        but faster for many annotations.'''
+        for a in annotations:
+            self.auto_annotate(a)
@@ -1,10 +1,19 @@
 # 2021-11-10 Antonio F. G. Sevilla <afgs@ucm.es>
 # Licensed under the Open Software License version 3.0
 
+import hashlib
 from inspect import signature
+import json
+import os
+from queue import Queue, Empty, Full
+from threading import Event, Thread
 
 from quevedo.annotation import Annotation, Logogram, Grapheme
-from quevedo.run_script import module_from_file
+from quevedo.profiling import profiled
+from quevedo.run_script import module_from_file, lambda_from_string
+
+# Number of images that predict_many runs through the pipeline at once
+PREDICT_BATCH = 16
 
 
 def create_pipeline(dataset, name=None, config=None):
@@ -66,6 +75,22 @@ class Pipeline:
         '''
         raise NotImplementedError
 
+    @profiled
+    def run_many(self, annotations, memo=None):
+        '''Run the pipeline on a list of annotations.
+
+        Each step of the pipeline is run on all of the annotations (or those
+        that reach it) at once, so that networks can process them in batches
+        instead of one by one.
+
+        Args:
+            annotations (list): Annotations to run the pipeline on.
+            memo (PipelineMemo): If given, results of network steps are reused
+                from (and stored into) it.
+        '''
+        for a in annotations:
+            self.run(a)
+
     def predict(self, image_path):
         '''Run the pipeline on the given image and return the resulting
         annotation.
@@ -76,13 +101,103 @@ class Pipeline:
         Returns:
             Annotation: The resulting annotation.
         '''
-        if Logogram.target in self.target:
-            a = Logogram(image_path)
-        else:
-            a = Grapheme(image_path)
+        a = self._new_annotation(image_path)
         self.run(a)
         return a
 
+    def predict_many(self, image_paths, write=None, batch_size=PREDICT_BATCH,
+                     prefetch=2):
+        '''Run the pipeline on many images.
+
+        Work is done in three stages which run concurrently: images are read
+        and decoded in a background thread, the pipeline is run on batches of
+        them, and the results are passed to `write` in another thread. Stages
+        are connected by queues of at most `prefetch` batches, so that
+        inference doesn't wait for the disk, but memory use is bounded.
+
+        Args:
+            image_paths: iterable of paths to the images.
+            write (callable): function to call with each resulting annotation,
+                in the same order as the images.
+            batch_size (int): number of images to run together.
+            prefetch (int): number of batches to keep ready in each queue.
+
+        Returns:
+            list: The resulting annotations, if `write` is not given.
+        '''
+        results = [] if write is None else None
+        errors = []
+        stop = Event()
+        decoded = Queue(prefetch)
+        done = Queue(prefetch)
+
+        # Queue operations give up when some stage has stopped
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    return q.put(item, timeout=0.1)
+                except Full:
+                    pass
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except Empty:
+                    pass
+
+        def decode():
+            try:
+                batch = []
+                for path in image_paths:
+                    a = self._new_annotation(path)
+                    a.image.load()
+                    batch.append(a)
+                    if len(batch) == batch_size:
+                        put(decoded, batch)
+                        batch = []
+                if len(batch) > 0:
+                    put(decoded, batch)
+                put(decoded, None)
+            except Exception as e:
+                put(decoded, e)
+
+        def write_back():
+            try:
+                while (batch := get(done)) is not None:
+                    for a in batch:
+                        if write is None:
+                            results.append(a)
+                        else:
+                            write(a)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        loader = Thread(target=decode, daemon=True)
+        writer = Thread(target=write_back, daemon=True)
+        loader.start()
+        writer.start()
+        try:
+            while (batch := get(decoded)) is not None:
+                if isinstance(batch, Exception):
+                    raise batch
+                self.run_many(batch)
+                put(done, batch)
+            put(done, None)
+            writer.join()
+        finally:
+            stop.set()
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def _new_annotation(self, image_path):
+        if Logogram.target in self.target:
+            return Logogram(image_path)
+        else:
+            return Grapheme(image_path)
+
 
 class SequencePipeline(Pipeline):
     '''A pipeline that runs a sequence of other pipelines. All steps should have
@@ -96,10 +211,16 @@ class SequencePipeline(Pipeline):
                       for i, step in enumerate(config)]
         self.target = self.steps[0].target
 
+    @profiled
     def run(self, a: Annotation):
         for p in self.steps:
             p.run(a)
 
+    @profiled
+    def run_many(self, annotations, memo=None):
+        for p in self.steps:
+            p.run_many(annotations, memo)
+
 
 class NetworkPipeline(Pipeline):
     '''A pipeline step that runs a network on the given annotation.'''
@@ -109,9 +230,19 @@ class NetworkPipeline(Pipeline):
         self.network = dataset.get_network(config)
         self.target = self.network.target
 
+    @profiled
     def run(self, a: Annotation):
         self.network.auto_annotate(a)
 
+    @profiled
+    def run_many(self, annotations, memo=None):
+        if len(annotations) == 0:
+            return
+        if memo is not None:
+            memo.run(self.network, annotations)
+        else:
+            self.network.auto_annotate_many(annotations)
+
 
 class LogogramPipeline(Pipeline):
     '''A pipeline for detecting graphemes within a logogram and then classifying
@@ -131,6 +262,7 @@ class LogogramPipeline(Pipeline):
 
         self.target = Logogram.target
 
+    @profiled
     def run(self, a: Annotation):
         if self.detect is not None:
             self.detect.run(a)
@@ -138,6 +270,15 @@ class LogogramPipeline(Pipeline):
             for g in a.graphemes:
                 self.classify.run(g)
 
+    @profiled
+    def run_many(self, annotations, memo=None):
+        if self.detect is not None:
+            self.detect.run_many(annotations, memo)
+        if self.classify is not None:
+            # Graphemes from all the logograms are classified together
+            self.classify.run_many([g for a in annotations for g in a.graphemes],
+                                   memo)
+
 
 class BranchPipeline(Pipeline):
     '''A pipeline that runs one of many possible branches depending on a
@@ -157,7 +298,7 @@ class BranchPipeline(Pipeline):
         crit = config['criterion']
         self.criterion = crit
         if crit.startswith('lambda'):
-            self.get_branch = eval(self.criterion)
+            self.get_branch = lambda_from_string(self.criterion, globals())
         elif crit in dataset.config['g_tags']:
             self.get_branch = lambda a, crit=crit: a.tags.get(crit)
         elif crit in dataset.config['l_tags']:
@@ -174,6 +315,7 @@ class BranchPipeline(Pipeline):
 
         self.target = self.branches[list(self.branches.keys())[0]].target
 
+    @profiled
     def run(self, a: Annotation):
         branch = self.get_branch(a)
         if branch is None and '*' in self.branches:
@@ -181,6 +323,19 @@ class BranchPipeline(Pipeline):
         if branch is not None:
             self.branches[branch].run(a)
 
+    @profiled
+    def run_many(self, annotations, memo=None):
+        # Group annotations by branch, so that each branch runs only once
+        groups = {}
+        for a in annotations:
+            branch = self.get_branch(a)
+            if branch is None and '*' in self.branches:
+                branch = '*'
+            if branch is not None:
+                groups.setdefault(branch, []).append(a)
+        for branch, group in groups.items():
+            self.branches[branch].run_many(group, memo)
+
 
 class FunctionPipeline(Pipeline):
     '''A pipeline that runs a user-defined function.
@@ -201,7 +356,7 @@ class FunctionPipeline(Pipeline):
         super().__init__(dataset, name, config)
 
         if config.startswith('lambda'):
-            self.function = eval(config)
+            self.function = lambda_from_string(config, globals())
         else:
             module, function = config.split(':')
             module = module_from_file(module, dataset.script_path)
@@ -213,5 +368,100 @@ class FunctionPipeline(Pipeline):
         except AttributeError:
             self.target = Logogram.target if a.name.startswith('l') else Grapheme.target
 
+    @profiled
     def run(self, a: Annotation):
         self.function(a, self.dataset)
+
+
+class PipelineMemo:
+    '''Stored results of the network steps of pipelines, so that they are not
+    computed again when the pipeline is run on the same annotations.
+
+    Results are kept for each network in the dataset `cache` directory, in a
+    file named after the network configuration and weights, so that they are
+    discarded when either changes. Each result is keyed by a hash of the input
+    annotation (image and annotated data), so if a previous step gives a
+    different output, the step is run again. Function steps are not memoized,
+    and always run.
+
+    Args:
+        dataset: the [Dataset](#dataset) the pipelines belong to.
+    '''
+
+    def __init__(self, dataset):
+        #: Name under which the memo is profiled.
+        self.name = 'memo'
+        #: Directory where the results are stored.
+        self.path = dataset.cache_path / 'pipeline'
+        self._tables = {}
+        self._changed = set()
+
+    def _table(self, network):
+        name = network.name
+        if name not in self._tables:
+            if not network.is_trained():
+                raise SystemExit("Please train neural network '{}' first".format(name))
+            fingerprint = _network_fingerprint(network)
+            try:
+                results = json.loads((self.path / name / f'{fingerprint}.json').read_text())
+            except FileNotFoundError:
+                results = {}
+            self._tables[name] = (fingerprint, results)
+        return self._tables[name][1]
+
+    @profiled
+    def run(self, network, annotations):
+        '''Automatically annotate the annotations with the network, reusing
+        the stored results when possible.'''
+        table = self._table(network)
+        todo = []
+        for a in annotations:
+            key = _annotation_hash(a)
+            result = table.get(key)
+            if result is not None:
+                a.update(**result)
+            else:
+                todo.append((a, key))
+        if len(todo) == 0:
+            return
+        network.auto_annotate_many([a for a, _ in todo])
+        for a, key in todo:
+            table[key] = {k: v for k, v in a.to_dict().items()
+                          if k not in ('fold', 'box')}
+        self._changed.add(network.name)
+
+    def save(self):
+        '''Persist the new results to the filesystem, removing those of
+        previous versions of the networks.'''
+        for name in self._changed:
+            fingerprint, results = self._tables[name]
+            table_d = self.path / name
+            table_d.mkdir(parents=True, exist_ok=True)
+            table = table_d / f'{fingerprint}.json'
+            tmp = table.with_name(table.name + '.tmp')
+            tmp.write_text(json.dumps(results))
+            os.replace(tmp, table)
+            for stale in table_d.glob('*.json'):
+                if stale != table:
+                    stale.unlink()
+            # Tables from before they were keyed by fingerprint
+            (self.path / f'{name}.json').unlink(missing_ok=True)
+        self._changed = set()
+
+
+def _network_fingerprint(network):
+    '''Summary of a network configuration and weights.'''
+    weights = (network.path / 'darknet_final.weights').stat()
+    return hashlib.sha1(json.dumps(
+        [network.config, weights.st_mtime, weights.st_size],
+        sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+def _annotation_hash(a):
+    '''Hash of the image and data of an annotation.'''
+    image = a.image
+    data = {k: v for k, v in a.to_dict().items() if k != 'fold'}
+    h = hashlib.sha1(json.dumps([image.mode, image.size, data],
+                                sort_keys=True, default=str).encode('utf8'))
+    h.update(image.tobytes())
+    return h.hexdigest()
@@ -0,0 +1,128 @@
+# 2026-10-19 Antonio F. G. Sevilla <afgs@ucm.es>
+# Licensed under the Open Software License version 3.0
+
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+# Profiler currently recording, if any
+_active = None
+
+
+class Profiler:
+    '''Collects timing information for pipeline steps and network predictions.
+
+    Profiling is opt-in: methods are only measured while a profiler is active,
+    which is done using it as a context manager. Times are inclusive, so the
+    time for a pipeline step also counts the time of its sub-steps.
+
+    ```
+    from quevedo.profiling import Profiler
+
+    with Profiler() as prof:
+        pipeline.predict('path/to/image.png')
+    print(prof.format())
+    ```
+    '''
+
+    def __init__(self):
+        # (name, method) -> list of (duration, items)
+        self._records = {}
+        self._lock = Lock()
+        self._previous = None
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        return False
+
+    def record(self, name, method, duration, items=1):
+        '''Register one call of a method.
+
+        Args:
+            name: name of the pipeline or network.
+            method: name of the method called.
+            duration: wall time of the call, in seconds.
+            items: number of annotations or images processed in the call.
+        '''
+        with self._lock:
+            self._records.setdefault((name, method), []).append((duration, items))
+
+    def report(self):
+        '''Get the collected statistics.
+
+        Returns:
+            a list of dictionaries, one for each step and method, in the
+            order they first finished, with the number of `calls`, `items`
+            processed, `total` wall time in seconds, `items_per_second`, and
+            the `p50`, `p90` and `p99` percentiles of the latency of each call,
+            in seconds.
+        '''
+        ret = []
+        with self._lock:
+            records = list(self._records.items())
+        for (name, method), calls in records:
+            total = sum(d for d, _ in calls)
+            items = sum(i for _, i in calls)
+            latencies = sorted(d for d, _ in calls)
+            ret.append({
+                'step': name,
+                'method': method,
+                'calls': len(calls),
+                'items': items,
+                'total': total,
+                'items_per_second': items / total if total > 0 else 0,
+                **{f'p{p}': percentile(latencies, p) for p in (50, 90, 99)},
+            })
+        return ret
+
+    def format(self):
+        '''Get the collected statistics as a printable table.'''
+        lines = ['{:<30} {:<18} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'step', 'method', 'calls', 'items', 'total(s)', 'items/s',
+            'p50(ms)', 'p90(ms)', 'p99(ms)')]
+        for r in self.report():
+            lines.append('{:<30} {:<18} {:>7} {:>7} {:>9.3f} {:>9.1f} '
+                         '{:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                             r['step'], r['method'], r['calls'], r['items'],
+                             r['total'], r['items_per_second'],
+                             r['p50'] * 1000, r['p90'] * 1000, r['p99'] * 1000))
+        return '\n'.join(lines)
+
+
+def percentile(values, p):
+    '''Nearest-rank percentile of a sorted list of values.'''
+    if len(values) == 0:
+        return 0
+    rank = max(1, -(-p * len(values) // 100))
+    return values[int(rank) - 1]
+
+
+def profiled(method):
+    '''Decorator for methods of pipelines and networks to be measured when
+    a [Profiler](#quevedoprofilingprofiler) is active.
+
+    Calls are recorded under the name of the object and the method. If some
+    argument is a list (of annotations or images), the length of the first one
+    is taken as the number of items processed.'''
+
+    @wraps(method)
+    def wrapper(self, *args, **kwds):
+        profiler = _active
+        if profiler is None:
+            return method(self, *args, **kwds)
+        items = next((len(a) for a in args if isinstance(a, list)), 1)
+        start = perf_counter()
+        try:
+            return method(self, *args, **kwds)
+        finally:
+            profiler.record(self.name, method.__name__,
+                            perf_counter() - start, items)
+
+    return wrapper
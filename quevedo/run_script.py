@@ -1,28 +1,73 @@
 # 2021-04-26 Antonio F. G. Sevilla <afgs@ucm.es>
 # Licensed under the Open Software License version 3.0
 
+import ast
 import click
 import importlib.util
+from pathlib import Path
 import re
 import sys
 
 from quevedo.annotation import Target
 
 
+# Modules already loaded, by file: (modification time, module)
+_modules = {}
+
+# Lambda expressions already compiled, by (source, namespace id)
+_lambdas = {}
+
+
 # Adapted from @wecsam
 # https://stackoverflow.com/questions/4383571/importing-files-from-different-folder
 def module_from_file(module_name, file_path):
-    file = (file_path / module_name).with_suffix('.py')
+    '''Load a python module from a file, given its name and directory.
+
+    Modules are only loaded once per process, and loaded again only if the file
+    is modified afterwards.'''
+    file = (Path(file_path) / module_name).with_suffix('.py')
+    mtime = file.stat().st_mtime
+    cached = _modules.get(file)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
     spec = importlib.util.spec_from_file_location(
         module_name, file, submodule_search_locations=[str(file_path)])
     module = importlib.util.module_from_spec(spec)
-    sys.modules[module_name] = module
-    if file_path not in sys.path:
+    # Don't replace other modules with the same name
+    previous = sys.modules.get(module_name)
+    if previous is None or getattr(previous, '__file__', None) == str(file):
+        sys.modules[module_name] = module
+    if str(file_path) not in sys.path:
         sys.path.append(str(file_path))
     spec.loader.exec_module(module)
+    _modules[file] = (mtime, module)
     return module
 
 
+def lambda_from_string(source, namespace):
+    '''Get the function for a lambda expression given as a string (for example
+    in the configuration file).
+
+    Expressions are only compiled once per process for each namespace. Only a
+    single lambda expression is accepted, so that nothing is run when the
+    value is loaded, but this is not a sandbox: the body of the lambda can do
+    anything when called.
+
+    Args:
+        source: source code of the lambda expression.
+        namespace: dictionary of global names the lambda can use.
+    '''
+    key = (source, id(namespace))
+    function = _lambdas.get(key)
+    if function is None:
+        tree = ast.parse(source.strip(), mode='eval')
+        if not isinstance(tree.body, ast.Lambda):
+            raise ValueError("Not a lambda expression: {}".format(source))
+        function = eval(compile(tree, '<config>', 'eval'), namespace)
+        _lambdas[key] = function
+    return function
+
+
 @click.command("run_script", context_settings=dict(
     ignore_unknown_options=True,
 ))
@@ -8,6 +8,60 @@ import random
 from quevedo.annotation import Target
 
 
+def _group_keys(a):
+    '''Keys that tie an annotation to others which must be in the same fold:
+    the original file it was imported from, and the logogram it was extracted
+    from (or that it is).'''
+    keys = []
+    if 'filename' in a.meta:
+        keys.append(('filename', a.meta['filename']))
+    if a.target == Target.LOGO:
+        keys.append(('logogram', '{}/{}'.format(a.image_path.parent.name, a.id)))
+    elif 'logogram' in a.meta:
+        keys.append(('logogram', a.meta['logogram']))
+    return keys
+
+
+def assign_folds(index, folds, rng=random):
+    '''Assign groups of annotations to folds, stratifying by a label.
+
+    Groups are placed, biggest first, in the fold with the fewest annotations of
+    the group's label so far (and then the fewest annotations overall), so that
+    each label is spread as evenly as possible among folds.
+
+    Args:
+        index: list of `(group, label)` pairs, one per annotation.
+        folds: list of folds to assign.
+        rng: random number generator to break ties.
+
+    Returns:
+        a dictionary from group to fold.
+    '''
+    groups = {}
+    for group, label in index:
+        groups.setdefault(group, []).append(label)
+
+    # Groups with mixed labels are stratified according to the most common
+    by_label = {}
+    for group, labels in groups.items():
+        label = max(set(labels), key=lambda l: (labels.count(l), str(l)))
+        by_label.setdefault(label, []).append((len(labels), group))
+
+    total = {f: 0 for f in folds}
+    assignment = {}
+    for label in sorted(by_label, key=str):
+        members = by_label[label]
+        rng.shuffle(members)
+        members.sort(key=lambda m: m[0], reverse=True)
+        count = {f: 0 for f in folds}
+        for size, group in members:
+            fold = min(folds, key=lambda f: (count[f], total[f]))
+            count[fold] += size
+            total[fold] += size
+            assignment[group] = fold
+    return assignment
+
+
 @click.command('split')
 @click.option('--grapheme-set', '-g', multiple=True, help="Grapheme set(s) to split.")
 @click.option('--logogram-set', '-l', multiple=True, help="Logogram set(s) to split.")
@@ -16,8 +70,13 @@ from quevedo.annotation import Target
 @click.option('--end-fold', '-e', type=click.INT,
               help='Maximum number to use for the folds.')
 @click.option('--seed', type=click.INT, help='A seed for the random split algorithm.')
+@click.option('--stratify', '-t', 'strat_tag',
+              help='Tag whose values should be evenly distributed among folds.')
+@click.option('--group/--no-group', default=False,
+              help='Keep annotations from the same file or logogram in the same fold.')
 @click.pass_obj
-def split(obj, grapheme_set, logogram_set, start_fold, end_fold, seed):
+def split(obj, grapheme_set, logogram_set, start_fold, end_fold, seed,
+          strat_tag, group):
     '''Assign annotations randomly to different folds.
 
     By default, the annotations will be split into a number of folds configured
@@ -36,7 +95,13 @@ def split(obj, grapheme_set, logogram_set, start_fold, end_fold, seed):
     annotations will be assigned randomly, so no proportions of
     graphemes/logograms/sets can be guaranteed for any fold. If the same fold
     proportions in each set are desired, run the command once for each of
-    them.'''
+    them.
+
+    To get the same proportion of each value of a tag in every fold, use the
+    `-t` option with the tag name. With `--group`, annotations imported from
+    the same original file, and graphemes extracted from the same logogram
+    (along with the logogram), are kept together in the same fold. Only
+    annotations whose fold changes are rewritten.'''
 
     dataset = obj['dataset']
     if end_fold is None:
@@ -44,7 +109,7 @@ def split(obj, grapheme_set, logogram_set, start_fold, end_fold, seed):
     else:
         end_fold = end_fold + 1  # Exclusive ranges
 
-    random.seed(seed)
+    rng = random.Random(seed)
 
     if len(grapheme_set) == 0 and len(logogram_set) == 0:
         an = dataset.get_annotations()
@@ -59,20 +124,46 @@ def split(obj, grapheme_set, logogram_set, start_fold, end_fold, seed):
                 logogram_set = None
             an = chain(an, dataset.get_annotations(Target.LOGO, logogram_set))
 
-    an = list(an)
-    random.shuffle(an)
-    number = end_fold - start_fold
-    amount = (len(an) // number)+((len(an) % number) > 0)
-
-    start = 0
-    for n in range(number):
-        end = start+amount
-        if end > len(an):
-            end = len(an)
-        for t in an[start:end]:
-            t.fold = start_fold + n
-            t.save()
-        remainder = end-start
-        start += amount
-    click.echo("Annotations split into {} folds, of {} files "
-       "(last fold {} files)".format(number, amount, remainder))
+    # Only keep the little information needed for each annotation, not the
+    # full objects, so that memory use doesn't grow with annotation size
+    paths = []
+    folds = []
+    index = []
+    # Union-find of groups, so that annotations sharing any key end together
+    parent = {}
+
+    def find(k):
+        while parent.setdefault(k, k) != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    for i, a in enumerate(an):
+        paths.append((a.target, a.image_path.parent.name, a.id))
+        folds.append(a.fold)
+        label = a.tags.get(strat_tag) if strat_tag is not None else None
+        if group:
+            for k in _group_keys(a):
+                parent[find(k)] = find(i)
+        index.append((i, label))
+    if group:
+        index = [(find(i), label) for i, label in index]
+
+    fold_range = list(range(start_fold, end_fold))
+    assignment = assign_folds(index, fold_range, rng)
+
+    sizes = {f: 0 for f in fold_range}
+    changed = 0
+    for (target, subset, id), old_fold, (node, _) in zip(paths, folds, index):
+        fold = assignment[node]
+        sizes[fold] += 1
+        if fold != old_fold:
+            a = dataset.get_single(target, subset, id)
+            a.fold = fold
+            a.save()
+            changed += 1
+
+    click.echo("Annotations split into {} folds, with sizes: {} ({} "
+               "annotations changed fold)".format(
+                   len(fold_range), ', '.join(str(sizes[f]) for f in fold_range),
+                   changed))
@@ -23,7 +23,10 @@ def launcher(obj, host, port, browser, mount_path, language):
     dataset files. Annotation pages are provided for both graphemes and
     logograms to allow visual annotation of objects. Very basic user management
     is also provided. Configuration can be written under the `web` key of the
-    dataset configuration.'''
+    dataset configuration.
+
+    By default, a development server is used. To serve many users at once, set
+    `server = "gunicorn"` in the configuration (gunicorn must be installed).'''
     from quevedo.web import app
 
     dataset = obj['dataset']
@@ -46,4 +49,10 @@ def launcher(obj, host, port, browser, mount_path, language):
     if browser:
         click.launch(url)
 
-    app.run(host, port, mount_path)
+    if config.get('server', 'development') == 'gunicorn':
+        app.run_production(host, port, mount_path,
+                           workers=config.get('workers', 4),
+                           threads=config.get('threads', 4),
+                           timeout=config.get('timeout', 120))
+    else:
+        app.run(host, port, mount_path)
@@ -2,19 +2,36 @@
 # Licensed under the Open Software License version 3.0
 # vi:foldmethod=marker
 
-from flask import Flask, request, send_from_directory, session, redirect
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, request, session, redirect, stream_with_context
 from functools import wraps
+import gzip
 import hashlib
 from itertools import chain
 import json
 import logging
+import mimetypes
 import os
 from pathlib import Path
 import re
+import socket
 from string import Template
+import tempfile
+from threading import Lock, Thread
+import time
+from uuid import uuid4
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+try:
+    import fcntl
+except ImportError:  # Not available in Windows
+    fcntl = None
 
 from quevedo.annotation import Annotation, Target
 from quevedo.run_script import module_from_file
+from quevedo.web.search import SearchIndex, TagValues
 
 os.environ['WERKZEUG_RUN_MAIN'] = 'true'
 app = Flask(__name__, static_url_path='')
@@ -29,18 +46,178 @@ def string_to_target(t):
     return Target.LOGO if t == 'logograms' else Target.GRAPH
 
 
-def annotation_info(a: Annotation):
+def annotation_info(id, data):
+    meta = data.get('meta', {})
     title_tag = app_data['meta_tags'][0]
-    title = a.meta.get(title_tag, '')
+    title = meta.get(title_tag, '')
     flags = app_data['flags']
     flag_icons = {f: icon for f, icon in flags.items()
-                  if a.meta.get(f, False)}
+                  if meta.get(f, False)}
     return {
-        'id': a.id, 'flags': flag_icons,
-        'set': a.fold, 'title': title
+        'id': id, 'flags': flag_icons,
+        'set': data.get('fold', -1), 'title': title
     }
 
 
+# Number of annotations sent by default, and at most, in each listing page
+LIST_PAGE = 100
+MAX_LIST_PAGE = 1000
+
+summary_lock = Lock()
+
+
+def subset_summary(target, dir, refresh=False):
+    '''Get the listing information of all the annotations in a subset.
+
+    Summaries are kept in memory, and annotations read again when refreshing
+    only if their file has been modified. Annotations read are also indexed for
+    searching and suggesting tag values. Returns a dictionary from id to
+    (modification time, annotation info).
+
+    The subset is read without holding the summary lock, which is only taken
+    to replace the summary, so that saving and searching don't have to wait for
+    it. Entries updated by `update_summary` in the meantime are kept.'''
+    key = (target, dir)
+    with summary_lock:
+        old = app_data['summaries'].get(key)
+    if old is not None and not refresh:
+        return old
+    old = old or {}
+    pngs = []
+    mtimes = {}
+    with os.scandir(app_data['path'] / target / dir) as files:
+        for f in files:
+            name, ext = os.path.splitext(f.name)
+            if ext == '.png':
+                pngs.append(name)
+            elif ext == '.json':
+                mtimes[name] = f.stat().st_mtime
+    summary = {}
+    read = {}
+    for id in pngs:
+        mtime = mtimes.get(id, 0)
+        entry = old.get(id)
+        if entry is None or entry[0] != mtime:
+            data = {}
+            if mtime != 0:
+                json_path = app_data['path'] / target / dir / (id + '.json')
+                try:
+                    data = json.loads(json_path.read_text())
+                except (OSError, ValueError) as e:
+                    # Probably being written by another process, try again in
+                    # the next refresh
+                    app.logger.warning("Can't read %s: %s", json_path, e)
+                    if entry is None:
+                        summary[id] = (0, annotation_info(id, {}))
+                    else:
+                        summary[id] = entry
+                    continue
+            entry = (mtime, annotation_info(id, data))
+            read[id] = data
+        summary[id] = entry
+    with summary_lock:
+        current = app_data['summaries'].get(key) or {}
+        for id, entry in current.items():
+            if entry is not old.get(id):
+                # Updated while reading the subset
+                summary[id] = entry
+                read.pop(id, None)
+        for id, data in read.items():
+            index_annotation(target, dir, id, data)
+        for id in old.keys() - summary.keys():
+            app_data['search'].remove((target, dir, id))
+            app_data['tag_values'].remove((target, dir, id))
+        app_data['summaries'][key] = summary
+    return summary
+
+
+def update_summary(target, dir, a: Annotation):
+    '''Update the cached listing information of an annotation.'''
+    with summary_lock:
+        summary = app_data['summaries'].get((target, dir))
+        if summary is not None:
+            data = a.to_dict()
+            summary[a.id] = (a.json_path.stat().st_mtime,
+                             annotation_info(a.id, data))
+            index_annotation(target, dir, a.id, data)
+
+
+def index_annotation(target, dir, id, data):
+    app_data['search'].update((target, dir, id), data)
+    app_data['tag_values'].update((target, dir, id), (target, dir), data)
+
+
+def sort_key(sort):
+    if sort == 'title':
+        return lambda i: i['title']
+    elif sort == 'set':
+        return lambda i: (i['set'], id_key(i['id']))
+    else:
+        return lambda i: id_key(i['id'])
+
+
+def id_key(id):
+    return (0, int(id), '') if id.isdigit() else (1, 0, id)
+
+
+def subset_ids(target, dir):
+    '''Get the sorted list of annotation ids in a subset, and a dictionary from
+    id to position in the list.
+
+    The list is cached, and only built again if the subset directory has been
+    modified (annotations added or removed) since.'''
+    path = app_data['path'] / target / dir
+    mtime = os.stat(path).st_mtime_ns
+    cached = app_data['subset_ids'].get((target, dir))
+    if cached is None or cached[0] != mtime:
+        ids = sorted((name[:-4] for name in os.listdir(path)
+                      if name.endswith('.png')), key=id_key)
+        cached = (mtime, ids, {id: i for i, id in enumerate(ids)})
+        app_data['subset_ids'][(target, dir)] = cached
+    return cached[1], cached[2]
+
+
+def file_etag(path):
+    '''Entity tag for a file, from its modification time and size.'''
+    st = os.stat(path)
+    return '{}-{}'.format(st.st_mtime_ns, st.st_size)
+
+
+def validated(etag, make_response, max_age=0):
+    '''Respond to a request for a resource with the given entity tag.
+
+    If the client already has it (`If-None-Match`), a 304 response is sent
+    without calling `make_response`. Responses can be reused by browsers for
+    `max_age` seconds, and afterwards must be validated again.'''
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = make_response()
+    resp.set_etag(etag)
+    if max_age > 0:
+        resp.cache_control.max_age = max_age
+    else:
+        resp.cache_control.no_cache = True
+    if app_data['public']:
+        resp.cache_control.public = True
+    else:
+        resp.cache_control.private = True
+    return resp
+
+
+def send_validated(path, mimetype, max_age=0):
+    '''Send a file, validated with its entity tag.'''
+    return validated(file_etag(path), lambda: app.response_class(
+        wrap_file(request.environ, open(path, 'rb')), mimetype=mimetype,
+        direct_passthrough=True), max_age)
+
+
+def page_response(html):
+    '''Send a page, validated with a hash of its content.'''
+    return validated(hashlib.sha1(html.encode('utf8')).hexdigest(),
+                     lambda: app.response_class(html, mimetype='text/html'))
+
+
 DEFAULT_COLOR_LIST = ['#FF0000', '#00FF00', '#0000FF', '#FF00FF', '#00FFFF',
                       '#880000', '#008800', '#000088', '#888800', '#008888']
 
@@ -53,6 +230,7 @@ def load_dataset(dataset, language):
     resolved = dataset.path.resolve()
     app_data['path'] = resolved
     app_data['config'] = dataset.config['web']
+    permission_cache.clear()
     app_data['public'] = app_data['config'].get('public', True)
     try:
         app.secret_key = app_data['config']['secret_key']
@@ -82,20 +260,74 @@ def load_dataset(dataset, language):
                       n.target == Target.LOGO},
     }
     app_data['color_list'] = dataset.config['web'].get('colors', DEFAULT_COLOR_LIST)
+    app_data['summaries'] = {}
+    app_data['search'] = SearchIndex()
+    app_data['tag_values'] = TagValues()
+    app_data['indexing_pid'] = None
+    app_data['heartbeat_pid'] = None
+    app_data['subset_ids'] = {}
+    app_data['thumb_path'] = dataset.cache_path / 'thumbnails'
+    app_data['job_path'] = dataset.cache_path / 'jobs'
+
+
+def preload():
+    '''Load all trained networks and pipelines, so that requests don't need to
+    wait for them.'''
+    ds = app_data['dataset']
+    for nets in app_data['nets'].values():
+        for name in nets:
+            nets[name] = ds.get_network(name)
+            nets[name].load()
+    for pipes in app_data['pipes'].values():
+        for name in pipes:
+            pipes[name] = ds.get_pipeline(name)
+    start_indexing()
 
 
 def run(host, port, path):
     app_data['mount_path'] = '/' + path + '/' if path != '' else '/'
+    start_indexing()
     app.run(host=host, port=port)
 
 
+def run_production(host, port, path, workers=4, threads=4, timeout=120):
+    '''Run the app with a gunicorn server with many worker processes.
+
+    Workers are threaded, since job progress streams keep a connection open
+    for a while and would otherwise hold a whole worker.
+
+    The dataset should be loaded before, so that all workers share the same
+    configuration and secret key. Each worker then loads the networks once when
+    starting.'''
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("Please install gunicorn to use the production server")
+    app_data['mount_path'] = '/' + path + '/' if path != '' else '/'
+
+    class Server(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set('bind', '{}:{}'.format(host, port))
+            self.cfg.set('workers', workers)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', threads)
+            self.cfg.set('timeout', timeout)
+
+        def load(self):
+            # Called in each worker after forking
+            preload()
+            return app
+
+    Server().run()
+
+
 # }}}
 # {{{ ---- AUTH
 
 @app.route('/login')
 def login_page():
-    if (app_data['public'] or
-            session.get('user', None) is not None):
+    if app_data['public'] or session_user() is not None:
         return redirect(app_data['mount_path'])
     ds = app_data['dataset']
     return html_template.substitute(
@@ -109,57 +341,179 @@ def login_page():
 def authenticated(func):
     @wraps(func)
     def check_auth(*args, **kwargs):
-        if (not app_data['public'] and
-                session.get('user', None) is None):
+        if not app_data['public'] and session_user() is None:
             return redirect(app_data['mount_path'] + 'login')
         return func(*args, **kwargs)
     return check_auth
 
 
-def can_do(path, action, compiled_action):
-    u = session.get('user')
-    if u is None:
-        return True
+def session_user():
+    '''Name of the logged in user, if any.'''
+    user = session.get('user', None)
+    # Older sessions stored the whole user configuration
+    return user if isinstance(user, str) else None
+
+
+# Permissions of each user for each action, compiled only once: True (all
+# subsets), False (none) or a single regular expression joining all patterns
+permission_cache = {}
+
+
+def user_permission(user, action):
     try:
-        perms = u[compiled_action]
+        return permission_cache[(user, action)]
     except KeyError:
-        perms = u.get(action, [])
-        if len(perms) == 0:
-            perms = 'NONE'
-        elif perms != 'ALL' and perms != 'NONE':
-            perms = [re.compile(r) for r in perms]
-        u[compiled_action] = perms
+        pass
+    perms = app_data['config'].get('users', {}).get(user, {}).get(action, [])
     if perms == 'ALL':
+        perm = True
+    elif perms == 'NONE' or len(perms) == 0:
+        perm = False
+    else:
+        perm = re.compile('|'.join('(?:{})'.format(r) for r in perms))
+    permission_cache[(user, action)] = perm
+    return perm
+
+
+def can_do(path, action):
+    user = session_user()
+    if user is None:
         return True
-    if perms == 'NONE':
-        return False
-    for p in perms:
-        if p.search(path):
-            return True
-    return False
+    perm = user_permission(user, action)
+    if perm is True or perm is False:
+        return perm
+    return perm.search(path) is not None
 
 
 def can_write(target, dir):
-    return can_do('{}/{}'.format(target, dir), 'write', 'write_')
+    return can_do('{}/{}'.format(target, dir), 'write')
 
 
 def can_read(target, dir):
-    return can_do('{}/{}'.format(target, dir), 'read', 'read_')
+    return can_do('{}/{}'.format(target, dir), 'read')
 
 
 # }}}
 # {{{ ---- API
 
+def annotation_version(a: Annotation):
+    '''Version stamp of an annotation, from the contents of its file.'''
+    try:
+        return hashlib.sha1(a.json_path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return hashlib.sha1(b'').hexdigest()
+
+
+# Parts of an annotation which can be changed independently by different
+# users. Edges refer to graphemes by position, so they go together.
+MERGE_FIELDS = (('meta',), ('tags',), ('graphemes', 'edges'), ('fold',))
+
+
+def merge_changes(current, changes, base):
+    '''Merge the changes sent by a client with an annotation that has been
+    modified by someone else since the client got it.
+
+    Args:
+        current: annotation data as it is now.
+        changes: new values of the fields the client is saving.
+        base: values of those fields when the client got the annotation.
+
+    Returns:
+        the changes to apply, or None if some part of the annotation has been
+        changed differently by both.
+    '''
+    if base is None:
+        return None
+    merged = {}
+    for fields in MERGE_FIELDS:
+        if not any(f in changes for f in fields):
+            continue
+        ours = [changes.get(f, current.get(f)) for f in fields]
+        theirs = [current.get(f) for f in fields]
+        original = [base.get(f, current.get(f)) for f in fields]
+        if theirs == original or theirs == ours:
+            merged.update({f: changes[f] for f in fields if f in changes})
+        elif ours != original:
+            return None
+    return merged
+
+
+# Checking the version and writing an annotation must not be interleaved. The
+# lock file is needed for worker processes, the lock for threads if there are
+# no file locks.
+save_lock = Lock()
+
+
+@contextmanager
+def saving():
+    with save_lock:
+        if fcntl is None:
+            yield
+            return
+        lock_path = app_data['dataset'].cache_path / 'save.lock'
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def save_changes(target, dir, idx, changes, matches=None, base=None):
+    '''Save changes to an annotation, checking that nobody else has saved it
+    since the changes were made.
+
+    Args:
+        changes: new values of the fields to save.
+        matches: function which receives the current version of the annotation
+            and returns whether it is the one the changes were made on. If not
+            given, changes are saved unconditionally.
+        base: values of the changed fields in the version the changes were
+            made on, to merge them if the annotation has been saved since.
+
+    Returns:
+        the annotation, its version, and whether the changes were merged with
+        others (True), saved directly (False) or not saved because they
+        conflict with others (None).
+    '''
+    ds = app_data['dataset']
+    merged = False
+    with saving():
+        single = ds.get_single(string_to_target(target), dir, idx)
+        version = annotation_version(single)
+        if matches is not None and not matches(version):
+            changes = merge_changes(single.to_dict(), changes, base)
+            if changes is None:
+                return single, version, None
+            merged = True
+        single.update(**changes)
+        single.save()
+        version = annotation_version(single)
+    update_summary(target, dir, single)
+    return single, version, merged
+
+
 @app.route('/api/save/<target>/<dir>/<idx>', methods=["POST"])
 @authenticated
 def edit_post(target, dir, idx):
+    '''Save the changes to an annotation.
+
+    If the request has an `If-Match` header with the version the client got,
+    and the annotation has been saved by someone else since, the changes are
+    merged with the saved ones if they touch different parts of the
+    annotation, using the original values sent by the client in `base`. If they
+    can't be merged, a 409 response is sent with the current annotation.'''
     if not can_write(target, dir):
         return "Unauthorized", 403
-    ds = app_data['dataset']
-    single = ds.get_single(string_to_target(target), dir, idx)
-    single.update(**request.get_json())
-    single.save()
-    return 'OK'
+    changes = request.get_json()
+    base = changes.pop('base', None)
+    matches = request.if_match.contains if request.if_match else None
+    single, version, merged = save_changes(target, dir, idx, changes,
+                                           matches, base)
+    if merged is None:
+        return {'version': version, 'anot': single.to_dict()}, 409
+    return {'version': version, 'anot': single.to_dict(), 'merged': merged}
 
 
 @app.route('/api/new/<target>/<dir>', methods=["POST"])
@@ -168,8 +522,12 @@ def new_annotation(target, dir):
     if not can_write(target, dir):
         return "Unauthorized", 403
     ds = app_data['dataset']
-    new_t = ds.new_single(string_to_target(target), dir,
-                          binary_data=request.data)
+    # Other workers may be choosing the same id
+    with saving():
+        new_t = ds.new_single(string_to_target(target), dir,
+                              binary_data=request.data)
+    update_summary(target, dir, new_t)
+    app_data['subset_ids'].pop((target, dir), None)
     return {'id': new_t.id}
 
 
@@ -183,17 +541,212 @@ def new_dir(target, dir):
     return 'OK'
 
 
+@app.route('/api/annotation/<target>/<dir>/<idx>')
+@authenticated
+def get_annotation(target, dir, idx):
+    if not can_read(target, dir):
+        return "Unauthorized", 403
+    ds = app_data['dataset']
+    a = ds.get_single(string_to_target(target), dir, idx)
+    if not a.image_path.exists():
+        return "Not found", 404
+    path = a.json_path if a.json_path.exists() else a.image_path
+    return validated(file_etag(path), lambda: app.response_class(
+        json.dumps(a.to_dict()), mimetype='application/json'))
+
+
+@app.route('/api/list/<target>/<dir>')
+@authenticated
+def list_subset(target, dir):
+    '''Get a page of the annotations in a subset.
+
+    Query arguments are `offset` and `limit` for the page, `sort` (`id`,
+    `title` or `set`) and `desc` for the order, and `flags` (comma separated)
+    and `mode` (`any`, `all` or `none`) to filter by flags. Changes made by
+    other processes are picked up by the background indexer.'''
+    if not can_read(target, dir):
+        return "Unauthorized", 403
+    args = request.args
+    offset = max(args.get('offset', 0, type=int), 0)
+    limit = min(args.get('limit', LIST_PAGE, type=int), MAX_LIST_PAGE)
+    summary = subset_summary(target, dir)
+    rows = [info for _, info in summary.values()]
+
+    flags = [f for f in args.get('flags', '').split(',') if f != '']
+    if len(flags) > 0:
+        mode = args.get('mode', 'any')
+        if mode == 'all':
+            rows = [i for i in rows if all(f in i['flags'] for f in flags)]
+        elif mode == 'none':
+            rows = [i for i in rows if not any(f in i['flags'] for f in flags)]
+        else:
+            rows = [i for i in rows if any(f in i['flags'] for f in flags)]
+
+    rows.sort(key=sort_key(args.get('sort', 'id')),
+              reverse=args.get('desc', 0, type=int) == 1)
+    return {'total': len(rows), 'items': rows[offset:offset + limit]}
+
+
+# Seconds between looking for annotations modified by other processes, to
+# index them. Changes made through this one are indexed right away.
+SEARCH_REFRESH = 30
+
+indexing_lock = Lock()
+
+
+def start_indexing():
+    '''Start indexing all subsets in a background thread, if not already
+    running in this process (workers are forked after loading the dataset).'''
+    with indexing_lock:
+        if app_data['indexing_pid'] == os.getpid():
+            return
+        app_data['indexing_pid'] = os.getpid()
+    Thread(target=index_subsets, daemon=True).start()
+
+
+def index_subsets():
+    '''Keep the summaries of all subsets, and so the search index and tag
+    values, up to date with the changes made by other processes.'''
+    while True:
+        try:
+            found = set(all_subsets())
+            for target, dir in found:
+                try:
+                    subset_summary(target, dir, refresh=True)
+                except Exception:
+                    # The previous summary is kept until the next refresh
+                    app.logger.exception("Can't index %s/%s", target, dir)
+            # Forget subsets which no longer exist
+            with summary_lock:
+                gone = [k for k in app_data['summaries'] if k not in found]
+                for key in gone:
+                    for id in app_data['summaries'].pop(key):
+                        app_data['search'].remove(key + (id,))
+                        app_data['tag_values'].remove(key + (id,))
+        except Exception:
+            app.logger.exception("Can't index the dataset")
+        time.sleep(SEARCH_REFRESH)
+
+
+def all_subsets():
+    for target in ('logograms', 'graphemes'):
+        try:
+            with os.scandir(app_data['path'] / target) as dirs:
+                yield from [(target, d.name) for d in dirs if d.is_dir()]
+        except FileNotFoundError:
+            pass
+
+
+def indexed_subsets(target=None, subset=None):
+    '''Get the summaries of the already indexed subsets that the user can
+    read. Nothing is read from disk, subsets are indexed in the background.
+
+    Returns a dictionary from (target, subset) to the summary.'''
+    start_indexing()
+    with summary_lock:
+        summaries = dict(app_data['summaries'])
+    return {(t, d): summary for (t, d), summary in summaries.items()
+            if target in (None, t) and subset in (None, d) and can_read(t, d)}
+
+
+def search_conditions(args, name):
+    '''Parse the `name:value` conditions given for a search argument. Returns
+    None if any is malformed.'''
+    conditions = []
+    for arg in args.getlist(name):
+        key, sep, value = arg.partition(':')
+        if sep == '':
+            return None
+        conditions.append((key, value))
+    return conditions
+
+
+@app.route('/api/search')
+@authenticated
+def search():
+    '''Search annotations by their tags and metadata, in all the subsets the
+    user can read.
+
+    Query arguments `tag` (exact value), `prefix` (start of the value), `meta`
+    (exact value) and `grapheme` (tag of some grapheme in a logogram) are
+    conditions of the form `name:value`, and `flag` is the name of a flag which
+    must be set. All can be repeated, and annotations
+    must match all of them. The search can be restricted to a `target` and
+    `subset`, and `offset` and `limit` select the page of results.'''
+    args = request.args
+    tags = search_conditions(args, 'tag')
+    prefixes = search_conditions(args, 'prefix')
+    meta = search_conditions(args, 'meta')
+    graphemes = search_conditions(args, 'grapheme')
+    if tags is None or prefixes is None or meta is None or graphemes is None:
+        return "Search conditions must be of the form name:value", 400
+    offset = max(args.get('offset', 0, type=int), 0)
+    limit = min(args.get('limit', LIST_PAGE, type=int), MAX_LIST_PAGE)
+
+    summaries = indexed_subsets(args.get('target'), args.get('subset'))
+    found = app_data['search'].search(tags, prefixes, meta,
+                                      args.getlist('flag'), graphemes)
+    found = sorted((k for k in found if k[:2] in summaries),
+                   key=lambda k: (k[0], k[1], id_key(k[2])))
+    items = []
+    for target, dir, id in found[offset:offset + limit]:
+        entry = summaries[(target, dir)].get(id)
+        if entry is not None:
+            items.append({'target': target, 'dir': dir, **entry[1]})
+    return {'total': len(found), 'items': items}
+
+
+# Number of values suggested by default, and at most
+SUGGEST_COUNT = 10
+MAX_SUGGEST_COUNT = 100
+
+
+@app.route('/api/suggest/<schema>/<tag>')
+@authenticated
+def suggest(schema, tag):
+    '''Get the most used values of a tag, in the subsets the user can read,
+    which start with the query argument `prefix`.
+
+    The schema is one of `g_tags`, `l_tags` or `e_tags`, and `k` is the number
+    of values to return.'''
+    if schema not in ('g_tags', 'l_tags', 'e_tags'):
+        return "Not found", 404
+    args = request.args
+    k = min(args.get('k', SUGGEST_COUNT, type=int), MAX_SUGGEST_COUNT)
+    groups = set(indexed_subsets())
+    values = app_data['tag_values'].top(schema, tag, args.get('prefix', ''),
+                                        k, groups)
+    return {'values': [{'value': v, 'count': n} for v, n in values]}
+
+
+# Networks and user scripts are not safe to run in many threads at once
+run_lock = Lock()
+
+
 @app.route('/api/run/<function>/<target>/<dir>/<idx>')
 @authenticated
 def run_backend(function, target, dir, idx):
     ds = app_data['dataset']
     an = ds.get_single(string_to_target(target), dir, idx)
+    with run_lock:
+        run = load_function(ds, function, target)
+        if run is None:
+            return "Unknown network, pipeline or script '{}'".format(function), 404
+        run([an])
+    return an.to_dict()
+
+
+def load_function(ds, function, target):
+    '''Get a function which runs the given network, pipeline or script on a
+    list of annotations, loading it first if needed.
+
+    Returns None if there is no such function for the target.'''
     if function in app_data['nets'][target]:
         net = app_data['nets'][target][function]
         if net is None:
             net = ds.get_network(function)
             app_data['nets'][target][function] = net
-        net.auto_annotate(an)
+        return net.auto_annotate_many
     elif function in app_data['scripts'][target]:
         script = app_data['scripts'][target][function]
         if script is None:
@@ -203,16 +756,15 @@ def run_backend(function, target, dir, idx):
             except AttributeError:
                 pass
             app_data['scripts'][target][function] = script
-        script.process(an, ds)
+        return lambda annotations: [script.process(a, ds) for a in annotations]
     elif function in app_data['pipes'][target]:
         pipe = app_data['pipes'][target][function]
         if pipe is None:
             pipe = ds.get_pipeline(function)
             app_data['pipes'][target][function] = pipe
-        pipe.run(an)
+        return pipe.run_many
     else:
-        return "Unknown network, pipeline or script '{}'".format(function), 404
-    return an.to_dict()
+        return None
 
 
 @app.route('/api/login', methods=["POST"])
@@ -222,16 +774,256 @@ def do_login():
         user = app_data['config']['users'][data["user"]]
         password = hashlib.new("sha1", data["pass"].encode("utf8")).hexdigest()
         if password == user['password']:
-            session['user'] = user
+            session['user'] = data['user']
             return redirect(app_data['mount_path'])
     except KeyError:
         pass
     return "Unauthorized", 403
 
 
+# }}}
+# {{{ ---- Background jobs
+
+# Annotations processed at once when running a function on a whole subset.
+# Other jobs can run in between batches.
+JOB_BATCH = 16
+# Seconds that finished jobs are remembered
+JOB_MAX_AGE = 24 * 3600
+# Seconds that an event stream is kept open before the browser has to
+# reconnect, so that workers are not held for too long
+JOB_STREAM_TIME = 25
+# Seconds between touching the files of unfinished jobs, and seconds without
+# it after which the process running them is considered gone
+JOB_HEARTBEAT = 10
+JOB_STALE = 60
+
+job_pool = ThreadPoolExecutor(max_workers=4)
+job_lock = Lock()
+# Unfinished jobs of this process
+live_jobs = set()
+
+
+def job_file(job_id):
+    if re.fullmatch('[0-9a-f]{32}', job_id) is None:
+        return None
+    return app_data['job_path'] / (job_id + '.json')
+
+
+def write_job(job):
+    '''Store the status of a job on disk, so that it can be reported by any
+    worker process.'''
+    path = job_file(job['id'])
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(json.dumps(job))
+    os.replace(tmp, path)
+
+
+def read_job(job_id):
+    '''Get the status of a job. Unfinished jobs whose process is gone are
+    reported as failed.'''
+    path = job_file(job_id)
+    if path is None:
+        return None
+    try:
+        job = json.loads(path.read_text())
+        heartbeat = path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+    if job['status'] in ('queued', 'running') and (
+            time.time() - heartbeat > JOB_STALE or not owner_alive(job)):
+        job['status'] = 'error'
+        job['error'] = 'The server process running the job has stopped'
+    return job
+
+
+def owner_alive(job):
+    '''Check whether the process that owns a job is still running, if it is
+    in this same machine.'''
+    if os.name != 'posix' or job.get('host') != socket.gethostname():
+        return True
+    try:
+        os.kill(job['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def keep_alive(job_id):
+    '''Start touching the file of a job periodically until it finishes, so
+    that other workers know that it is still being run.'''
+    with job_lock:
+        live_jobs.add(job_id)
+        if app_data['heartbeat_pid'] == os.getpid():
+            return
+        app_data['heartbeat_pid'] = os.getpid()
+    Thread(target=job_heartbeat, daemon=True).start()
+
+
+def job_heartbeat():
+    while True:
+        time.sleep(JOB_HEARTBEAT)
+        with job_lock:
+            ids = list(live_jobs)
+        for job_id in ids:
+            try:
+                os.utime(job_file(job_id))
+            except FileNotFoundError:
+                pass
+
+
+def submit_job(function, target, dir, ids, save):
+    '''Queue running a function on some annotations of a subset.
+
+    If `save` is true, annotations are saved after being processed. If not, the
+    results are stored in the job for the client to retrieve.'''
+    job_dir = app_data['job_path']
+    job_dir.mkdir(parents=True, exist_ok=True)
+    now = time.time()
+    for old in job_dir.glob('*.json'):
+        try:
+            if now - old.stat().st_mtime > JOB_MAX_AGE:
+                old.unlink()
+        except FileNotFoundError:
+            pass
+    job = {
+        'id': uuid4().hex,
+        'function': function,
+        'target': target,
+        'dir': dir,
+        'status': 'queued',
+        'done': 0,
+        'total': len(ids),
+        'conflicts': 0,
+        'pid': os.getpid(),
+        'host': socket.gethostname(),
+    }
+    write_job(job)
+    keep_alive(job['id'])
+    job_pool.submit(run_job, dict(job), ids, save)
+    return job
+
+
+def run_job(job, ids, save):
+    ds = app_data['dataset']
+    target, dir = job['target'], job['dir']
+    results = []
+    job['status'] = 'running'
+    write_job(job)
+    try:
+        for start in range(0, len(ids), JOB_BATCH):
+            batch = [ds.get_single(string_to_target(target), dir, id)
+                     for id in ids[start:start + JOB_BATCH]]
+            # Annotations as read, to merge the results with any changes
+            # saved in the meantime
+            read = [(annotation_version(a), json.loads(json.dumps(a.to_dict())))
+                    for a in batch]
+            with run_lock:
+                load_function(ds, job['function'], target)(batch)
+            for a, (version, base) in zip(batch, read):
+                if save:
+                    _, _, merged = save_changes(target, dir, a.id, a.to_dict(),
+                                                version.__eq__, base)
+                    if merged is None:
+                        job['conflicts'] += 1
+                else:
+                    results.append(a.to_dict())
+            job['done'] += len(batch)
+            write_job(job)
+        job['status'] = 'done'
+        if not save:
+            job['results'] = results
+    except Exception as e:
+        job['status'] = 'error'
+        job['error'] = str(e)
+    write_job(job)
+    with job_lock:
+        live_jobs.discard(job['id'])
+
+
+def job_response(function, target, dir, ids, save):
+    if (function not in app_data['nets'][target] and
+            function not in app_data['scripts'][target] and
+            function not in app_data['pipes'][target]):
+        return "Unknown network, pipeline or script '{}'".format(function), 404
+    return submit_job(function, target, dir, ids, save), 202
+
+
+@app.route('/api/jobs/<function>/<target>/<dir>/<idx>', methods=["POST"])
+@authenticated
+def run_job_single(function, target, dir, idx):
+    '''Run a function on an annotation in the background. The results are
+    not saved, but returned in the job once finished.'''
+    if not can_read(target, dir):
+        return "Unauthorized", 403
+    if idx not in subset_ids(target, dir)[1]:
+        return "Not found", 404
+    return job_response(function, target, dir, [idx], False)
+
+
+@app.route('/api/jobs/<function>/<target>/<dir>', methods=["POST"])
+@authenticated
+def run_job_subset(function, target, dir):
+    '''Run a function on all the annotations of a subset in the background,
+    saving them.'''
+    if not can_write(target, dir):
+        return "Unauthorized", 403
+    return job_response(function, target, dir,
+                        list(subset_ids(target, dir)[0]), True)
+
+
+@app.route('/api/job/<job_id>')
+@authenticated
+def job_status(job_id):
+    job = read_job(job_id)
+    if job is None:
+        return "Not found", 404
+    return job
+
+
+@app.route('/api/job/<job_id>/events')
+@authenticated
+def job_events(job_id):
+    '''Stream the status of a job as server-sent events, every time it
+    changes, until it finishes.'''
+    if read_job(job_id) is None:
+        return "Not found", 404
+
+    def events():
+        yield 'retry: 1000\n\n'
+        last = None
+        end = time.monotonic() + JOB_STREAM_TIME
+        while time.monotonic() < end:
+            job = read_job(job_id)
+            if job is None:
+                return
+            data = json.dumps(job)
+            if data != last:
+                yield 'data: {}\n\n'.format(data)
+                last = data
+            if job['status'] in ('done', 'error'):
+                return
+            time.sleep(0.25)
+
+    resp = app.response_class(stream_with_context(events()),
+                              mimetype='text/event-stream')
+    resp.cache_control.no_cache = True
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
 # }}}
 # {{{ ---- WEB APP
 
+def target_functions(target):
+    '''Names of the networks, pipelines and scripts that can be run on
+    annotations of the target.'''
+    return [f for f in chain(app_data['nets'][target].keys(),
+                             app_data['pipes'][target].keys(),
+                             app_data['scripts'][target].keys())]
+
+
 html_template = Template((Path(__file__).parent /
                           'static/page.html').read_text())
 
@@ -263,19 +1055,16 @@ def index(target, dir):
     else:
         data['target'] = target
         data['dir_name'] = dir
-        annots = ds.get_annotations(string_to_target(target), dir)
-        data['list'] = sorted((annotation_info(an)
-                              for an in annots),
-                              key=lambda i: int(i['id']))
+        data['functions'] = target_functions(target) if can_write(target, dir) else []
         readme = ds.path / target / dir / 'README.md'
         if readme.exists():
             data['description'] = readme.read_text()
 
-    return html_template.substitute(
+    return page_response(html_template.substitute(
         title=ds.config['title'],
         mount_path=app_data['mount_path'],
         page='list',
-        data=json.dumps(data))
+        data=json.dumps(data)))
 
 
 @app.route('/edit/<target>/<dir>/<idx>')
@@ -289,19 +1078,15 @@ def edit(target, dir, idx):
     target_ = string_to_target(target)
     idn = int(idx)
 
-    if idn > 1:
-        prev_link = idn - 1
-    else:
-        prev_link = sum(1 for _ in (ds.path / full_dir).glob('*.png'))
-
-    next_link = idn + 1
-    if not (ds.path / full_dir / str(next_link)).with_suffix('.png').exists():
-        next_link = 1
+    ids, positions = subset_ids(target, dir)
+    pos = positions.get(idx)
+    if pos is None:
+        return "Not found", 404
+    prev_link = ids[pos - 1]
+    next_link = ids[(pos + 1) % len(ids)]
 
     a = ds.get_single(target_, dir, idx)
-    functions = [f for f in chain(app_data['nets'][target].keys(),
-                                  app_data['pipes'][target].keys(),
-                                  app_data['scripts'][target].keys())]
+    functions = target_functions(target)
 
     data = {
         'title': ds.config['title'],
@@ -325,26 +1110,132 @@ def edit(target, dir, idx):
         'meta_tags': ds.config['meta_tags'],
         'color_list': app_data['color_list'],
         'anot': a.to_dict(),
+        'version': annotation_version(a),
     }
-    return html_template.substitute(
+    return page_response(html_template.substitute(
         title='{} - {}'.format(ds.config['title'], idx),
         mount_path=app_data['mount_path'],
         page='edit',
-        data=json.dumps(data))
+        data=json.dumps(data)))
+
+
+# Seconds browsers can use static files before asking again
+STATIC_MAX_AGE = 3600
+
+# Contents of static files, by path: (etag, data, gzipped data)
+static_cache = {}
+
+
+def send_static(filename):
+    '''Send a static file of the web app. Files are compressed only once, and
+    sent compressed to browsers which accept it.'''
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return "Not found", 404
+    etag = file_etag(path)
+    use_gzip = request.accept_encodings['gzip'] > 0
+    cached = static_cache.get(path)
+    if cached is None or cached[0] != etag:
+        data = Path(path).read_bytes()
+        cached = (etag, data, gzip.compress(data))
+        static_cache[path] = cached
+
+    def make_response():
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if use_gzip:
+            resp = app.response_class(cached[2], mimetype=mimetype)
+            resp.content_encoding = 'gzip'
+        else:
+            resp = app.response_class(cached[1], mimetype=mimetype)
+        return resp
+
+    # Each encoding is a different representation, with its own tag
+    resp = validated(etag + ('-gz' if use_gzip else ''), make_response,
+                     STATIC_MAX_AGE)
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+app.view_functions['static'] = send_static
 
 
 @app.route('/i18n.js')
 def internationalization():
-    return app.send_static_file('i18n/{}.js'.format(app_data['lang']))
+    return send_static('i18n/{}.js'.format(app_data['lang']))
 
 
 @app.route('/img/<target>/<dir>/<filename>')
 def send_image(target, dir, filename):
-    return send_from_directory(app_data['path'] / target / dir, filename)
+    path = safe_join(str(app_data['path']), target, dir, filename)
+    if path is None or not os.path.isfile(path):
+        return "Not found", 404
+    return send_validated(path, mimetypes.guess_type(filename)[0])
+
+
+# Allowed sizes (of the longest side) for thumbnails
+THUMB_SIZES = (128, 256, 512)
+# Seconds browsers can use thumbnails before asking again
+THUMB_MAX_AGE = 3600
+
+thumb_pool = ThreadPoolExecutor()
+thumb_jobs = {}
+thumb_lock = Lock()
+
+
+def make_thumbnail(source, thumb, size, mtime):
+    from PIL import Image
+    img = Image.open(source)
+    img.thumbnail((size, size))
+    thumb.parent.mkdir(parents=True, exist_ok=True)
+    # Other workers may be generating the same thumbnail
+    fd, tmp = tempfile.mkstemp(dir=thumb.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, format='PNG')
+        # The thumbnail keeps the modification time of the source, to know
+        # whether it is still valid
+        os.utime(tmp, ns=(mtime, mtime))
+        os.replace(tmp, thumb)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def get_thumbnail(source, thumb, size, mtime):
+    '''Wait for a thumbnail to be generated in the background pool. Requests
+    for the same thumbnail share the work.'''
+    with thumb_lock:
+        job = thumb_jobs.get(thumb)
+        if job is None:
+            job = thumb_pool.submit(make_thumbnail, source, thumb, size, mtime)
+            thumb_jobs[thumb] = job
+            job.add_done_callback(lambda _: thumb_jobs.pop(thumb, None))
+    job.result()
+
+
+@app.route('/thumb/<int:size>/<target>/<dir>/<filename>')
+def send_thumbnail(size, target, dir, filename):
+    source = safe_join(str(app_data['path']), target, dir, filename)
+    if size not in THUMB_SIZES or source is None:
+        return "Not found", 404
+    try:
+        st = os.stat(source)
+    except FileNotFoundError:
+        return "Not found", 404
+
+    def make_response():
+        thumb = app_data['thumb_path'] / str(size) / target / dir / filename
+        if not (thumb.exists() and thumb.stat().st_mtime_ns == st.st_mtime_ns):
+            get_thumbnail(source, thumb, size, st.st_mtime_ns)
+        return app.response_class(thumb.read_bytes(), mimetype='image/png')
+
+    return validated('{}-{}-{}'.format(size, st.st_mtime_ns, st.st_size),
+                     make_response, THUMB_MAX_AGE)
 
 
 @app.route('/quevedo_logo.png')
 def favicon():
-    return send_from_directory(Path(__file__).parent.parent.resolve(), 'logo_icon.png')
+    return send_validated(Path(__file__).parent.parent.resolve() / 'logo_icon.png',
+                          'image/png', STATIC_MAX_AGE)
 
 # }}}
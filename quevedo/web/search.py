@@ -0,0 +1,219 @@
+# 2026-10-19 Antonio F. G. Sevilla <afgs@ucm.es>
+# Licensed under the Open Software License version 3.0
+
+from bisect import bisect_left
+from collections import Counter
+import heapq
+import json
+from threading import Lock
+
+
+def term_value(value):
+    '''Tag and meta values are indexed as strings, other values (like flags)
+    as their json representation.'''
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+class SearchIndex:
+    '''Inverted index of the tags and metadata of annotations.
+
+    Annotations are identified by any hashable key, and indexed by terms
+    `(kind, name, value)`, where kind is either `tag`, `meta` or, for
+    logograms, `grapheme` (the tags of the graphemes they contain). Queries are
+    answered intersecting the sets of annotations for each condition, so they
+    don't depend on the number of annotations but on the number of results.
+    '''
+
+    def __init__(self):
+        # key -> set of terms
+        self._docs = {}
+        # (kind, name) -> value -> set of keys
+        self._postings = {}
+        # (kind, name) -> sorted list of values, for prefix queries
+        self._values = {}
+        self._lock = Lock()
+
+    def update(self, key, data):
+        '''Index (again) an annotation.
+
+        Args:
+            key: identifier of the annotation.
+            data: annotation data, as returned by `to_dict`.
+        '''
+        terms = set()
+        for kind, field in (('tag', 'tags'), ('meta', 'meta')):
+            for name, value in (data.get(field) or {}).items():
+                if value is not None:
+                    terms.add((kind, name, term_value(value)))
+        for g in data.get('graphemes') or ():
+            for name, value in (g.get('tags') or {}).items():
+                if value is not None:
+                    terms.add(('grapheme', name, term_value(value)))
+        with self._lock:
+            self._remove(key)
+            for kind, name, value in terms:
+                values = self._postings.setdefault((kind, name), {})
+                if value not in values:
+                    values[value] = set()
+                    self._values.pop((kind, name), None)
+                values[value].add(key)
+            self._docs[key] = terms
+
+    def remove(self, key):
+        '''Remove an annotation from the index.'''
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        for kind, name, value in self._docs.pop(key, ()):
+            values = self._postings[(kind, name)]
+            values[value].discard(key)
+            if len(values[value]) == 0:
+                del values[value]
+                self._values.pop((kind, name), None)
+
+    def search(self, tags=(), prefixes=(), meta=(), flags=(), graphemes=()):
+        '''Find the annotations matching all the given conditions.
+
+        Args:
+            tags: list of `(name, value)` pairs, tags which must have exactly
+                the value.
+            prefixes: list of `(name, prefix)` pairs, tags whose value must
+                start with the prefix.
+            meta: list of `(name, value)` pairs, metadata fields which must have
+                exactly the value.
+            flags: list of names of flags which must be set.
+            graphemes: list of `(name, value)` pairs, tags which some grapheme
+                in the logogram must have with exactly the value.
+
+        Returns:
+            a set with the keys of the matching annotations. If no condition is
+            given, all annotations match.
+        '''
+        with self._lock:
+            matches = []
+            for name, value in tags:
+                matches.append(self._postings.get(('tag', name), {}).get(value, set()))
+            for name, value in meta:
+                matches.append(self._postings.get(('meta', name), {}).get(value, set()))
+            for name, value in graphemes:
+                matches.append(self._postings.get(('grapheme', name), {}).get(value, set()))
+            for name in flags:
+                matches.append(self._postings.get(('meta', name), {}).get('true', set()))
+            for name, prefix in prefixes:
+                matches.append(self._prefixed(('tag', name), prefix))
+            if len(matches) == 0:
+                return set(self._docs)
+            matches.sort(key=len)
+            return matches[0].intersection(*matches[1:])
+
+    def _prefixed(self, field, prefix):
+        postings = self._postings.get(field, {})
+        values = self._values.get(field)
+        if values is None:
+            values = sorted(postings)
+            self._values[field] = values
+        ret = set()
+        i = bisect_left(values, prefix)
+        while i < len(values) and values[i].startswith(prefix):
+            ret |= postings[values[i]]
+            i += 1
+        return ret
+
+
+class TagValues:
+    '''Frequency of the values of each tag, to suggest them to annotators.
+
+    Values are counted for the tags of the schemas `g_tags` (graphemes, also
+    those in logograms), `l_tags` (logograms) and `e_tags` (edges). Counts are
+    kept separately for each group of annotations (like a subset), so that
+    suggestions can be restricted to some of them.
+    '''
+
+    def __init__(self):
+        # key -> (group, Counter of (schema, tag, value))
+        self._docs = {}
+        # (schema, tag) -> value -> group -> count
+        self._counts = {}
+        # (schema, tag) -> sorted list of values, for prefix queries
+        self._values = {}
+        self._lock = Lock()
+
+    def update(self, key, group, data):
+        '''Count (again) the tag values of an annotation.
+
+        Args:
+            key: identifier of the annotation.
+            group: group the annotation belongs to.
+            data: annotation data, as returned by `to_dict`.
+        '''
+        found = Counter()
+
+        def add(schema, tags):
+            for name, value in (tags or {}).items():
+                if isinstance(value, str) and value != '':
+                    found[(schema, name, value)] += 1
+
+        if 'graphemes' in data:
+            add('l_tags', data.get('tags'))
+            for g in data['graphemes'] or ():
+                add('g_tags', g.get('tags'))
+            for e in data.get('edges') or ():
+                add('e_tags', e.get('tags'))
+        else:
+            add('g_tags', data.get('tags'))
+        with self._lock:
+            self._remove(key)
+            for (schema, name, value), n in found.items():
+                values = self._counts.setdefault((schema, name), {})
+                if value not in values:
+                    values[value] = {}
+                    self._values.pop((schema, name), None)
+                values[value][group] = values[value].get(group, 0) + n
+            self._docs[key] = (group, found)
+
+    def remove(self, key):
+        '''Stop counting the tag values of an annotation.'''
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        group, found = self._docs.pop(key, (None, ()))
+        for (schema, name, value), n in dict(found).items():
+            values = self._counts[(schema, name)]
+            groups = values[value]
+            groups[group] -= n
+            if groups[group] == 0:
+                del groups[group]
+                if len(groups) == 0:
+                    del values[value]
+                    self._values.pop((schema, name), None)
+
+    def top(self, schema, tag, prefix='', k=10, groups=None):
+        '''Get the most frequent values of a tag which start with a prefix.
+
+        Args:
+            schema: `g_tags`, `l_tags` or `e_tags`.
+            tag: name of the tag.
+            prefix: start of the values to find.
+            k: maximum number of values to return.
+            groups: if given, only count values in these groups.
+
+        Returns:
+            a list of `(value, count)` pairs, most frequent first.
+        '''
+        with self._lock:
+            counts = self._counts.get((schema, tag), {})
+            values = self._values.get((schema, tag))
+            if values is None:
+                values = sorted(counts)
+                self._values[(schema, tag)] = values
+            found = []
+            i = bisect_left(values, prefix)
+            while i < len(values) and values[i].startswith(prefix):
+                n = sum(c for g, c in counts[values[i]].items()
+                        if groups is None or g in groups)
+                if n > 0:
+                    found.append((values[i], n))
+                i += 1
+        return heapq.nsmallest(k, found, key=lambda f: (-f[1], f[0]))
@@ -5,14 +5,16 @@ import Text from './i18n.js';
 import { useChangeStack, useList, useDict, useSavedState } from './common_state.js';
 import { LogogramEditor } from './logo.js';
 import { GraphemeEditor } from './graph.js';
+import { runJob } from './jobs.js';
+import { suggest, suggestList } from './suggest.js';
 
 const html = htm.bind(preact.h);
-const { useState } = preactHooks;
+const { useState, useEffect, useRef } = preactHooks;
 
 
 preact.render(html`<${App} ...${window.quevedo_data} />`, document.body);
 
-function App ({ title, target, id, annotation_help, links, anot,
+function App ({ title, target, id, annotation_help, links, anot, version,
     functions, g_tags, l_tags, e_tags, meta_tags, flags, color_list }) {
 
     const changes = useChangeStack();
@@ -23,9 +25,26 @@ function App ({ title, target, id, annotation_help, links, anot,
     const edges = is_logo?useList(anot.edges, changes):null;
     const tags = useDict(anot.tags, changes);
 
+    // Prefetch the next annotation page and image, so that it loads quickly
+    useEffect(() => {
+        for (const href of [ `edit/${id.dir}/${links.next}`,
+                `img/${id.dir}/${links.next}.png` ]) {
+            const link = document.createElement('link');
+            link.rel = 'prefetch';
+            link.href = href;
+            document.head.appendChild(link);
+        }
+    }, []);
+
+    // Last version of the annotation saved in the server, to detect changes
+    // made by others in the meantime
+    const saved = useRef({ version, anot });
+
     const [ message, setMessage ] = useState('');
     const setError = resp => {
-        if (resp.status < 500) {
+        if (typeof resp == 'string') {
+            setMessage(`${Text['error']}: ${resp}`);
+        } else if (resp.status < 500) {
             resp.text().then(e => setMessage(`${Text['error']}: ${e}`));
         } else {
             setMessage(`${Text['error']}: ${resp.statusText}`);
@@ -35,20 +54,45 @@ function App ({ title, target, id, annotation_help, links, anot,
     const saveChanges = () => {
         changes.setSaving();
         setMessage(Text['saving']);
-        let body = { meta: meta.dict, tags: tags.dict };
+        const base = saved.current.anot;
+        let body = { meta: meta.dict, tags: tags.dict,
+            base: { meta: base.meta, tags: base.tags } };
         if (is_logo) {
             body.graphemes = graphemes.list;
             body.edges = edges.list;
+            body.base.graphemes = base.graphemes;
+            body.base.edges = base.edges;
         }
         fetch(`api/save/${id.full}`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: {
+                'Content-Type': 'application/json',
+                'If-Match': `"${saved.current.version}"`,
+            },
             body: JSON.stringify(body)
         }).then(r => {
-            if (r.ok) {
-                changes.setSaved();
-                setMessage(Text['saved']);
+            if (r.ok) return r.json();
+            else if (r.status == 409) {
+                setMessage(Text['conflict']);
+                if (confirm(Text['conflict_reload'])) {
+                    window.location.reload();
+                }
             } else throw r;
+        }).then(data => {
+            if (data === undefined) return;
+            saved.current = { version: data.version, anot: data.anot };
+            if (data.merged) {
+                // Show the changes by others, so that they are not reverted
+                // when saving again
+                meta.set(data.anot.meta, 'MERGE_META');
+                tags.set(data.anot.tags, 'MERGE_TAGS');
+                if (is_logo) {
+                    graphemes.set(data.anot.graphemes, 'MERGE_GRAPHEMES');
+                    edges.set(data.anot.edges, 'MERGE_EDGES');
+                }
+            }
+            changes.setSaved();
+            setMessage(Text[data.merged?'saved_merged':'saved']);
         }).catch(setError);
     };
 
@@ -57,12 +101,11 @@ function App ({ title, target, id, annotation_help, links, anot,
             !confirm(Text['warning_save'])) {
             return;
         }
-        fetch(`api/run/${fun_name}/${id.full}`)
-        .then(r => {
-            if (r.ok) {
-                return r.json();
-            } else throw r;
-        }).then(data => {
+        setMessage(Text['running']);
+        runJob(`api/jobs/${fun_name}/${id.full}`)
+        .then(job => {
+            setMessage('');
+            const data = job.results[0];
             meta.set(data.meta, 'UPD_META_ALL');
             if (is_logo) {
                 // sort graphemes left-to-right (roughly) and top-to-bottom (strict)
@@ -87,6 +130,7 @@ function App ({ title, target, id, annotation_help, links, anot,
             message, show_save: changes.dirty>0, runFunction,
             functions, changes }} />
         <${TagEditor} schema=${is_logo?l_tags:g_tags}
+            schema_name=${is_logo?'l_tags':'g_tags'}
             ...${{meta_tags, flags, meta, tags }} />
         ${is_logo?
             html`<${LogogramEditor} ...${{id, graphemes, edges, g_tags,
@@ -117,7 +161,7 @@ function Header ({ title, id, links, saveChanges, message, show_save,
     </header>`;
 }
 
-function TagEditor ({ meta_tags, meta, schema, tags, flags }) {
+function TagEditor ({ meta_tags, meta, schema, schema_name, tags, flags }) {
     const text_tags = meta_tags.filter(t => flags[t]==undefined);
     return html`<table class="TagEditor">
         ${text_tags.map((k, i) => html`<tr
@@ -134,7 +178,12 @@ function TagEditor ({ meta_tags, meta, schema, tags, flags }) {
             ${i>0?html`<th></th>`:html`<th>${Text['tags']}</th>`}
             <th>${t}:</th>
             <td><input type=text value=${tags.dict[t] || ''}
-                oninput=${e => tags.update(t, e.target.value, `UPD_TAG_${t}`)}
+                list=${suggestList(schema_name, t)}
+                onfocus=${e => suggest(schema_name, t, e.target.value)}
+                oninput=${e => {
+                    tags.update(t, e.target.value, `UPD_TAG_${t}`);
+                    suggest(schema_name, t, e.target.value);
+                }}
             /></td>
         </tr>`)}
         <tr class="first">
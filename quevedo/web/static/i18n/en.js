@@ -21,10 +21,19 @@ export default {
     all: 'All', // Every filter must match
     any: 'Any', // At least one filter must match
     none: 'None', // No filter can match
+    confirm_run_subset: 'Run on all the annotations in this subset, saving the results?',
+    run_subset: 'Run on the whole subset',
+    running: 'Running...', // A function is being run in the server
+    done: 'Done', // A function finished running in the server
+    not_saved: 'Not saved, changed by someone else', // Annotations not saved after running a function
+    connection_lost: 'Lost connection to the server', // Progress of a function in the server can't be followed
     // EDIT.js
     warning_save: 'Warning: unsaved changes will be lost', // Warning when trying to leave without saving
     saving: 'Saving...', // Message when sending changes to server
     saved: 'Saved', // Message when changes were succesfully saved
+    saved_merged: 'Saved, along with changes by others',
+    conflict: 'Not saved, changed by someone else',
+    conflict_reload: 'Someone else has changed this annotation in the meantime. Reload it? (your changes will be lost)',
     meta: 'Metadata', // Additional information for an annotation
     annotation: 'Annotation', // Title of annotation
     tags: 'Tags', // Title of tags
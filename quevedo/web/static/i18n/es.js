@@ -21,10 +21,19 @@ export default {
     all: 'Todos', // Every filter must match
     any: 'Alguno', // At least one filter must match
     none: 'Ninguno', // No filter can match
+    confirm_run_subset: '¿Ejecutar en todas las anotaciones de este conjunto, guardando los resultados?',
+    run_subset: 'Ejecutar en todo el conjunto',
+    running: 'Ejecutando...',
+    done: 'Hecho',
+    not_saved: 'No guardadas, modificadas por otra persona',
+    connection_lost: 'Se ha perdido la conexión con el servidor',
     // EDIT.js
     warning_save: 'Atención: se perderán los cambios sin guardar', // Warning when trying to leave without saving
     saving: 'Guardando...', // Message when sending changes to server
     saved: 'Guardado', // Message when changes were succesfully saved
+    saved_merged: 'Guardado, junto con cambios de otros',
+    conflict: 'No guardado, modificado por otra persona',
+    conflict_reload: 'Otra persona ha modificado esta anotación mientras tanto. ¿Recargarla? (se perderán tus cambios)',
     meta: 'Metadatos', // Additional information for an annotation
     annotation: 'Anotación',
     tags: 'Etiquetas', // Title of tags
@@ -0,0 +1,47 @@
+// 2026-10-19 Antonio F. G. Sevilla <afgs@ucm.es>
+// Licensed under the Open Software License version 3.0
+
+import Text from './i18n.js';
+
+// Start a function (network, pipeline or script) in the server as a background
+// job, and wait for it to finish. `onProgress` is called with the job status
+// every time it changes. Returns a promise that resolves to the finished job,
+// or rejects with the failed response or the error message of the job.
+export function runJob (url, onProgress) {
+    return fetch(url, { method: 'POST' })
+        .then(r => {
+            if (r.ok) return r.json();
+            else throw r;
+        }).then(job => new Promise((resolve, reject) => {
+            // The browser reconnects to the stream by itself when the server
+            // closes it, until the job is finished
+            const events = new EventSource(`api/job/${job.id}/events`);
+            events.onmessage = e => {
+                const job = JSON.parse(e.data);
+                if (job.status == 'done') {
+                    events.close();
+                    resolve(job);
+                } else if (job.status == 'error') {
+                    events.close();
+                    reject(job.error);
+                } else if (onProgress) {
+                    onProgress(job);
+                }
+            };
+            // Connection errors are expected when the server closes the
+            // stream, but if the job is gone or the browser gives up
+            // reconnecting, waiting any longer is useless
+            events.onerror = () => {
+                if (events.readyState == EventSource.CLOSED) {
+                    reject(Text['connection_lost']);
+                    return;
+                }
+                fetch(`api/job/${job.id}`).then(r => {
+                    if (r.status == 404) {
+                        events.close();
+                        reject(r);
+                    }
+                }).catch(() => {});
+            };
+        }));
+}
@@ -3,21 +3,25 @@
 
 import Text from './i18n.js';
 import { useSavedState } from './common_state.js';
+import { runJob } from './jobs.js';
 
 const MAX_ANNO_TITLE = 20;
+const PAGE_SIZE = 100;
 
 const html = htm.bind(preact.h);
-const { useState, useRef } = preactHooks;
+const { useState, useRef, useEffect } = preactHooks;
 
 preact.render(html`<${App} ...${window.quevedo_data} />`, document.body);
 
 function App ({ title, path, description, dir_name, target,
-        list, list2, flags }) {
+        list, list2, flags, functions }) {
     const in_dir = dir_name !== undefined;
 
     const [ message, setMessage ] = useState('');
     const setError = resp => {
-        if (resp.status < 500) {
+        if (typeof resp == 'string') {
+            setMessage(`${Text['error']}: ${resp}`);
+        } else if (resp.status < 500) {
             resp.text().then(e => setMessage(`${Text['error']}: ${e}`));
         } else {
             setMessage(`${Text['error']}: ${resp.statusText}`);
@@ -42,33 +46,62 @@ function App ({ title, path, description, dir_name, target,
     const [ filter, setFilter ] = useSavedState('filter', {});
     const [ _filterMode, setFilterMode ] = useSavedState('filterMode', 'any');
     const search = Object.keys(filter).filter(f => filter[f] == true);
-    let view = list;
     let filterMode = '';
     if (in_dir && search.length>0) {
         filterMode = _filterMode;
-        if (_filterMode === 'any') {
-            view = list.filter(t => search.some(s => t.flags[s]));
-        } else if (_filterMode === 'all') {
-            view = list.filter(t => search.every(s => t.flags[s]));
-        } else if (_filterMode === 'none') {
-            view = list.filter(t => search.every(s => !t.flags[s]));
-        }
     }
+    // Annotations are filtered in the server
+    const query = `flags=${encodeURIComponent(search.join(','))}&mode=${filterMode}`;
 
     return html`
         <header>
             ${in_dir?html`<a href="">${title}</a> » ${target}/${dir_name}`:title}
             <span class="message_text">${message}</span>
+            ${in_dir && functions.length>0?html`<${RunOnSubset}
+                ...${{ path, target, dir_name, functions, setMessage, setError }} />`:null}
         </header>
         <pre><b>(${path})</b></pre>
         <pre>${description}</pre>
         ${in_dir?html`<${Filter} ...${{ flags, filter, setFilter, filterMode,
             setFilterMode }} />`:null}
-        <${in_dir?AnnoList:DirList} list=${view} list2=${list2}
-            upload=${filterMode===''?upload:null} />
+        ${in_dir?html`<${AnnoList} key=${query} query=${query}
+            target=${target} dir_name=${dir_name} setError=${setError}
+            upload=${filterMode===''?upload:null} />`:
+        html`<${DirList} list=${list} list2=${list2} upload=${upload} />`}
     `;
 }
 
+function RunOnSubset ({ path, target, dir_name, functions, setMessage, setError }) {
+    // Functions differ between datasets and targets
+    const [ saved, setSelected ] = useSavedState(
+        `subset_function.${path}.${target}`, '');
+    const selected = functions.includes(saved)?saved:'';
+    const [ running, setRunning ] = useState(false);
+    const run = () => {
+        if (!confirm(Text['confirm_run_subset'])) return;
+        setRunning(true);
+        setMessage(Text['running']);
+        runJob(`api/jobs/${selected}/${target}/${dir_name}`,
+            job => setMessage(`${Text['running']} ${job.done}/${job.total}`))
+            .then(job => {
+                setMessage(`${Text['done']} ${job.done}/${job.total}`+
+                    (job.conflicts>0?` (${Text['not_saved']}: ${job.conflicts})`:''));
+                setRunning(false);
+            }).catch(e => {
+                setError(e);
+                setRunning(false);
+            });
+    };
+    return html`<span>
+        <select onchange=${e => setSelected(e.target.value)} value=${selected}>
+            <option value="">${Text['run_subset']}</option>
+            ${functions.map(e=>html`<option value=${e}>${e}</option>`)}
+        </select>
+        <button disabled=${selected=='' || running} onclick=${run}
+            title=${Text['run_subset']}>⚙️</button>
+    </span>`;
+}
+
 function Filter ({ flags, filter, setFilter, filterMode, setFilterMode }) {
     return html`<form class="Filter">
         ${Text['quick_filter']}: ${Object.keys(flags).map(f => {
@@ -130,15 +163,53 @@ function NewDir ({ upload }) {
     </li>`;
 }
 
-function AnnoList ({ list, upload }) {
+function AnnoList ({ target, dir_name, query, setError, upload }) {
+    const [ list, setList ] = useState([]);
+    const [ total, setTotal ] = useState(null);
+    const loading = useRef(false);
+    const done = total !== null && list.length >= total;
+    const loadMore = () => {
+        if (loading.current || done) return;
+        loading.current = true;
+        fetch(`api/list/${target}/${dir_name}?offset=${list.length}&limit=${PAGE_SIZE}&${query}`)
+            .then(r => {
+                if (r.ok) return r.json();
+                else throw r;
+            }).then(page => {
+                setList(list => list.concat(page.items));
+                setTotal(page.total);
+                loading.current = false;
+            }).catch(e => {
+                loading.current = false;
+                setError(e);
+            });
+    };
     return html`<ul class="List">
         <${UpEntry} />
-        ${list.map(t => html`<${AnnoEntry} ...${t} />`)}
-        ${upload?html`<${NewEntry} upload=${upload} />`:null}
-        <li class="extra-space"></li>
+        ${list.map(t => html`<${AnnoEntry} key=${t.id} ...${t} />`)}
+        ${done && upload?html`<${NewEntry} upload=${upload} />`:null}
+        ${done?html`<li class="extra-space"></li>`:
+            html`<${LoadMore} count=${list.length} onVisible=${loadMore} />`}
     </ul>`;
 }
 
+function LoadMore ({ count, onVisible }) {
+    // Load the next page when the end of the list comes into view. The
+    // observer is created again after each page, since it reports whether it
+    // is visible when starting to observe.
+    const ref = useRef(null);
+    const callback = useRef(onVisible);
+    callback.current = onVisible;
+    useEffect(() => {
+        const observer = new IntersectionObserver(entries => {
+            if (entries[0].isIntersecting) callback.current();
+        }, { rootMargin: '50%' });
+        observer.observe(ref.current);
+        return () => observer.disconnect();
+    }, [count]);
+    return html`<li class="extra-space" ref=${ref}></li>`;
+}
+
 function UpEntry () {
     return html`<li class="Entry DirEntry">
         <h2>${Text['back']}</h2>
@@ -176,7 +247,8 @@ function AnnoEntry ({ id, title, set, flags }) {
     return html`<li class="Entry LogoEntry">
         <h2>${id} — ${title}</h2>
         <a href="${edit_link}">
-            <img src="img/${dir}/${id}.png" />
+            <img src="thumb/256/${dir}/${id}.png"
+                srcset="thumb/256/${dir}/${id}.png 1x, thumb/512/${dir}/${id}.png 2x" />
         </a>
         <p>
             ${Object.keys(flags).map(f => html`<span title=${f} class="flag">
@@ -6,6 +6,7 @@ const { useState, useEffect, useRef } = preactHooks;
 
 import Text from './i18n.js';
 import { useList, useSavedState } from './common_state.js';
+import { suggest, suggestList } from './suggest.js';
 
 let next_color = 0;
 function getNextColor (color_list) {
@@ -386,6 +387,7 @@ function TagTable ({ mode, columns, objects, colors, being_edited, setEditing, r
                         s => ({ ...s, tags: {...s.tags, [k]: v}}),
                         `${mode}_${i}_UPD_TAG_${k}`)}
                 columns=${columns}
+                schema=${mode=='graphemes'?'g_tags':'e_tags'}
                 colors=${colors}
                 color1=${mode=='graphemes'?i:s.start}
                 color2=${mode=='edges'?s.end:null}
@@ -416,7 +418,7 @@ function TagTable ({ mode, columns, objects, colors, being_edited, setEditing, r
     </table></div>`;
 }
 
-function GraphemeEntry ({ tags, changeTag, columns, remove,
+function GraphemeEntry ({ tags, changeTag, columns, schema, remove,
         colors, color1, color2, markEditing, highlight, navigate }) {
     return html`<tr class=${`GraphemeEntry ${highlight}`}
         onclick=${markEditing}>
@@ -428,9 +430,16 @@ function GraphemeEntry ({ tags, changeTag, columns, remove,
         </td>
         ${columns.map(c => html`<td><input type=text
             placeholder=${c} tabIndex=1 value=${tags[c] || ''}
-            oninput=${e => changeTag(c, e.target.value)}
+            list=${suggestList(schema, c)}
+            oninput=${e => {
+                changeTag(c, e.target.value);
+                suggest(schema, c, e.target.value);
+            }}
             onkeydown=${navigate}
-            onfocus=${markEditing} /></td>`)}
+            onfocus=${e => {
+                markEditing(e);
+                suggest(schema, c, e.target.value);
+            }} /></td>`)}
         <td><button onclick=${e => {remove(); e.stopPropagation();}}>🗑️</button></td>
     </tr>`;
 }
@@ -0,0 +1,53 @@
+// 2026-10-19 Antonio F. G. Sevilla <afgs@ucm.es>
+// Licensed under the Open Software License version 3.0
+
+// Suggestions of tag values, from the values most used in the dataset. Inputs
+// for a tag use `suggestList` as their `list` attribute, and call `suggest`
+// with what has been typed so that the browser offers the values.
+
+const SUGGEST_COUNT = 10;
+
+// Values already received, by url
+const received = {};
+// Last url requested for each list, to ignore answers arriving late
+const latest = {};
+
+function datalist (id) {
+    let list = document.getElementById(id);
+    if (list === null) {
+        list = document.createElement('datalist');
+        list.id = id;
+        document.body.appendChild(list);
+    }
+    return list;
+}
+
+export function suggestList (schema, tag) {
+    const id = `suggest_${schema}_${tag}`;
+    datalist(id);
+    return id;
+}
+
+export function suggest (schema, tag, prefix) {
+    const id = suggestList(schema, tag);
+    const url = `api/suggest/${schema}/${encodeURIComponent(tag)}`+
+        `?prefix=${encodeURIComponent(prefix)}&k=${SUGGEST_COUNT}`;
+    latest[id] = url;
+    const show = values => {
+        if (latest[id] != url) return;
+        datalist(id).replaceChildren(...values.map(v => {
+            const option = document.createElement('option');
+            option.value = v.value;
+            return option;
+        }));
+    };
+    if (received[url] !== undefined) {
+        show(received[url]);
+        return;
+    }
+    fetch(url).then(r => r.ok?r.json():{ values: [] })
+        .then(({ values }) => {
+            received[url] = values;
+            show(values);
+        }).catch(() => {});
+}